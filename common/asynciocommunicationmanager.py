@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    A CommunicationManager running on an asyncio event loop (trollius on
+    Python 2, uvloop when it is installed).
+
+    The API and the events are those of CommunicationManager: connection
+    handles, protoIn / protoOut callbacks and CommunicationManagerHandler
+    work unchanged. Sockets are watched with the add_reader / add_writer
+    callbacks of the event loop and timeouts are call_later timers, so the
+    manager can share its loop with coroutines: request handlers may return
+    a future or a coroutine (see CommunicationManagerHandler.handleRequest).
+
+    Usage:
+
+        >>> com = AsyncioCommunicationManager()
+        >>> merger = Merger(com)
+        >>> com.listenUnix("/tmp/llmerger", negotiate, protoOut)
+        >>> com.main()
+"""
+
+import os
+import fcntl
+import select
+import socket
+import errno
+import sys
+import bdb
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from common.communicationmanager import CommunicationManager, convertPollState
+
+## asyncio.async became ensure_future in Python 3.4.4
+ensureFuture = getattr(asyncio, "ensure_future", None) or getattr(asyncio, "async")
+
+
+def newEventLoop():
+    """
+        @return: an uvloop event loop if available, else an asyncio one
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+class AsyncioPoller(object):
+    """
+        Poller (see PollPoller) turning registrations into event loop
+        readers and writers. Ready descriptors are given to the manager
+        dispatch method, one callback per event.
+    """
+    def __init__(self, cm):
+        self.cm = cm
+        self.loop = cm.eventLoop
+        self.registered = {}
+        # regular files can't be watched by epoll: they are always ready
+        self.files = {}
+
+    def register(self, fd, events):
+        self.registered[fd] = 0
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        old = self.registered[fd]
+        self.registered[fd] = events
+        if fd in self.files:
+            self.files[fd] = events
+            return
+        try:
+            if events & select.POLLIN and not old & select.POLLIN:
+                self.loop.add_reader(fd, self.cm._dispatch, fd, select.POLLIN)
+            if events & select.POLLOUT and not old & select.POLLOUT:
+                self.loop.add_writer(fd, self.cm._dispatch, fd, select.POLLOUT)
+        except (IOError, OSError), e:
+            if e.errno != errno.EPERM:
+                raise
+            self.loop.remove_reader(fd)
+            self.files[fd] = events
+            self.loop.call_soon(self.readyFile, fd)
+            return
+        if not events & select.POLLIN and old & select.POLLIN:
+            self.loop.remove_reader(fd)
+        if not events & select.POLLOUT and old & select.POLLOUT:
+            self.loop.remove_writer(fd)
+
+    def unregister(self, fd):
+        self.modify(fd, 0)
+        del self.registered[fd]
+        self.files.pop(fd, None)
+
+    def readyFile(self, fd):
+        events = self.files.get(fd)
+        if events is None:
+            return
+        self.loop.call_soon(self.readyFile, fd)
+        self.cm._dispatch(fd, events)
+
+    def close(self):
+        for fd in self.registered.keys():
+            self.unregister(fd)
+
+
+class AsyncioCommunicationManager(CommunicationManager):
+    """
+        CommunicationManager running on an asyncio event loop. See
+        CommunicationManager for the API.
+    """
+    def __init__(self, blocking=True, protoIn=None, protoOut=None, eventLoop=None):
+        """
+            @param eventLoop: the event loop to run on. Default to a new
+            uvloop or asyncio loop.
+
+            See CommunicationManager.__init__ for the other parameters.
+        """
+        self.eventLoop = eventLoop or newEventLoop()
+        # timeout handle -> call_later handle
+        self.timers = {}
+        self.nextTimer = 0
+        CommunicationManager.__init__(self, blocking, protoIn, protoOut,
+            poller=lambda: AsyncioPoller(self))
+        fd = self.wakeupPipe[0]
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def _dispatch(self, fd, event):
+        """
+            Event loop callback: fd is ready for event.
+        """
+        if fd == self.wakeupPipe[0]:
+            ## the readiness may be stale: a previous callback of the same
+            ## loop iteration may have emptied the pipe
+            try:
+                os.read(fd, 255)
+                self._throwLowLevelEvent((fd, "WAKE UP CLEARED"))
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            self._turn()
+            return
+        try:
+            ch = self.chs.get(fd)
+            if ch is not None and ch.connecting and event & select.POLLOUT:
+                ## poll reports a failed connection with POLLERR
+                if ch.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                    event = select.POLLERR
+            self._throwLowLevelEvent((fd, convertPollState(event)))
+            self._managePollReturn([(fd, event)])
+        except bdb.BdbQuit:
+            raise
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+            self._throwLowLevelEvent((None, "EXCEPTION", sys.exc_info()))
+        self._turn()
+
+    def _turn(self):
+        """
+            End of a callback: update the registrations, and stop the event
+            loop when there is nothing more to do.
+        """
+        self._managePollList()
+        if self.connectionCount == 0 and not self.running and self.poll.registered:
+            ## done: remove the wakeup pipe reader, and stop the loop once
+            self.poll.close()
+            self.eventLoop.stop()
+
+    def loop(self):
+        """
+            Do one event loop iteration, without waiting.
+            return True if it want to loop another time
+            return False when it has nothing more to do.
+        """
+        self._managePollList()
+        if self.connectionCount == 0 and not self.running:
+            return False
+        self.eventLoop.call_soon(self.eventLoop.stop)
+        self.eventLoop.run_forever()
+        return True
+
+    def main(self):
+        """
+            Run the event loop until the manager is stopped.
+        """
+        self._throwLowLevelEvent((None, "MAIN LOOP STARTED"))
+        self._managePollList()
+        while self.connectionCount != 0 or self.running:
+            try:
+                self.eventLoop.run_forever()
+            except KeyboardInterrupt:
+                if self.stopOnKeyboardInterruptFlag:
+                    self.stop()
+                else:
+                    self._throwHighLevelEvent(("keyboard interrupt",))
+                    self._throwLowLevelEvent((None, "EXCEPTION", sys.exc_info()))
+        self.poll.close()
+        self._throwLowLevelEvent((None, "MAIN LOOP STOPPED"))
+
+    def setTimeout(self, timeout, payload=None):
+        """
+            Throw a Timeout event when timeout ms has passed.
+            @param timeout: timeout in seconds (as a float)
+            @return: a timeout handle (as a int)
+        """
+        r = self.nextTimer
+        self.nextTimer += 1
+        self.eventLoop.call_soon_threadsafe(self._startTimer, r, timeout, payload)
+        self._throwLowLevelEvent((None, "TIMEOUT ADDED", r, timeout))
+        return r
+
+    def _startTimer(self, handle, timeout, payload):
+        self.timers[handle] = self.eventLoop.call_later(timeout, self._fireTimeout, handle, payload)
+
+    def _fireTimeout(self, handle, payload):
+        del self.timers[handle]
+        self._throwLowLevelEvent((None, "TIMEOUT", handle))
+        self._throwHighLevelEvent(("timeout", payload))
+        self._turn()
+
+    def cancelTimeout(self, handle):
+        """
+            Cancel a timeout
+            @param handle: the previously given handle
+        """
+        self.eventLoop.call_soon_threadsafe(self._cancelTimer, handle)
+        self._throwLowLevelEvent((None, "TIMEOUT CANCELED", handle))
+
+    def _cancelTimer(self, handle):
+        ## _startTimer has run: callbacks are called in order
+        timer = self.timers.pop(handle, None)
+        if timer is not None:
+            timer.cancel()
+
+    def ensureFuture(self, coroutine):
+        """
+            @return: a task running the coroutine on the event loop
+        """
+        return ensureFuture(coroutine, loop=self.eventLoop)
+
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    Compact binary protocol for high rate channel updates (faders).
+
+    The protocol is chosen per connection by the negotiate protoIn callback:
+    a connection starting with the MAGIC bytes uses this protocol, any other
+    one uses the JSON protocol. Answers are always sent as JSON, so use a
+    JSON connection for control and status requests.
+
+    After the magic, the stream is a sequence of fixed size records, in
+    network byte order:
+        - layer id (uint16), as returned by the "new layer" request
+        - address (uint32)
+        - value (uint32)
+        - mode (uint8): MIX, MIN, MAX, or KEEP to leave the mixType as is
+        - padding (1 byte)
+        - mix factor (float64), only used with MIX
+"""
+import sys, os
+sys.path.append(os.path.join(".."))
+
+import struct
+import math
+
+from common.communicationmanager import ConnectionHandle
+from common.jsonprotocol import protoIn as jsonProtoIn
+
+MAGIC = "LLB1"
+RECORD = struct.Struct("!HIIBxd")
+
+MIX = 0
+MIN = 1
+MAX = 2
+KEEP = 3
+
+modes = {
+    MIN: "min",
+    MAX: "max",
+}
+mixTypes = dict((mixType, mode) for mode, mixType in modes.items())
+
+
+class ChannelUpdates(list):
+    """
+        A packet of decoded records, as (layer id, address, value, mixType)
+        tuples. mixType is a float, "min", "max" or None to keep it.
+
+        Records with an unknown mode or a non finite MIX factor are dropped,
+        and described in the errors list.
+    """
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.errors = []
+
+
+def pack(lid, address, value, mixType=None):
+    """
+        Encode one channel update record.
+    """
+    if mixType is None:
+        return RECORD.pack(lid, address, value, KEEP, 0.0)
+    if mixType in mixTypes:
+        return RECORD.pack(lid, address, value, mixTypes[mixType], 0.0)
+    return RECORD.pack(lid, address, value, MIX, mixType)
+
+
+class BinaryProtocol(object):
+
+    def parse(self, data):
+        """
+            Decode all complete records of data.
+            @return: (ChannelUpdates, number of bytes consumed)
+        """
+        return self.parseBuffer(data, 0, len(data))
+
+    def parseBuffer(self, buffer, start, end):
+        """
+            Decode all complete records of buffer[start:end], in place.
+            @return: (ChannelUpdates, number of bytes consumed)
+        """
+        updates = ChannelUpdates()
+        size = RECORD.size
+        count = (end - start) // size
+        for offset in xrange(start, start + count * size, size):
+            lid, address, value, mode, mix = RECORD.unpack_from(buffer, offset)
+            if mode == MIX:
+                if math.isinf(mix) or math.isnan(mix):
+                    updates.errors.append("Bad mix factor: %d %d %s" % (lid, address, mix))
+                    continue
+                mixType = mix
+            elif mode == KEEP:
+                mixType = None
+            elif mode in modes:
+                mixType = modes[mode]
+            else:
+                updates.errors.append("Bad mode: %d %d %d" % (lid, address, mode))
+                continue
+            updates.append((lid, address, value, mixType))
+        return updates, count * size
+
+
+def feedRecords(p):
+    def feedRecordsWorker(ch):
+        updates, consumed = p.parseBuffer(*ch.getInBuffer())
+        ch.clearInData(consumed)
+        if len(updates) or updates.errors:
+            return (ConnectionHandle.OK, [updates])
+        return (ConnectionHandle.UNDEFINED, [])
+    return feedRecordsWorker
+
+def negotiate(ch):
+    """
+        protoIn callback selecting the binary or the JSON protocol from the
+        first bytes of a connection.
+    """
+    data = ch.getInData()
+    if len(data) < len(MAGIC) and MAGIC.startswith(data):
+        return (ConnectionHandle.UNDEFINED, [])
+    if data.startswith(MAGIC):
+        ch.clearInData(len(MAGIC))
+        ch.protoIn = feedRecords(BinaryProtocol())
+        return ch.protoIn(ch)
+    return jsonProtoIn(ch)
+
+
+
+from unittest import TestCase
+from unittest import main
+
+class BinaryProtocolTest(TestCase):
+
+    def test_records(self):
+        data = pack(1, 2, 3) + pack(4, 5, 6, 0.25) + pack(7, 8, 9, "max")
+        updates, consumed = BinaryProtocol().parse(data + data[:5])
+        self.assertEqual(consumed, 3 * RECORD.size)
+        self.assertEqual(updates, [(1, 2, 3, None), (4, 5, 6, 0.25), (7, 8, 9, "max")])
+
+        buffer = bytearray("xx" + data + data[:5])
+        self.assertEqual(BinaryProtocol().parseBuffer(buffer, 2, len(buffer) - 1), (updates, consumed))
+
+    def test_bad_records(self):
+        data = (RECORD.pack(1, 2, 3, 7, 0.0) + pack(4, 5, 6, float("nan")) +
+            pack(7, 8, 9, float("-inf")) + pack(1, 2, 3, "min"))
+        updates, consumed = BinaryProtocol().parse(data)
+        self.assertEqual(consumed, 4 * RECORD.size)
+        self.assertEqual(updates, [(1, 2, 3, "min")])
+        self.assertEqual(len(updates.errors), 3)
+
+        ch = ConnectionHandle(None, None)
+        ch.addInData(MAGIC + RECORD.pack(1, 2, 3, 7, 0.0))
+        status, packets = negotiate(ch)
+        self.assertEqual(status, ConnectionHandle.OK)
+        self.assertEqual(packets, [[]])
+        self.assertEqual(len(packets[0].errors), 1)
+
+    def test_negotiate_binary(self):
+        ch = ConnectionHandle(None, None)
+        ch.addInData(MAGIC[:2])
+        self.assertEqual(ch.protoIn, None)
+        self.assertEqual(negotiate(ch), (ConnectionHandle.UNDEFINED, []))
+
+        ch.addInData(MAGIC[2:] + pack(1, 2, 3)[:10])
+        self.assertEqual(negotiate(ch), (ConnectionHandle.UNDEFINED, []))
+        self.assertNotEqual(ch.protoIn, None)
+
+        ch.addInData(pack(1, 2, 3)[10:])
+        self.assertEqual(ch.protoIn(ch), (ConnectionHandle.OK, [[(1, 2, 3, None)]]))
+        self.assertEqual(ch.getInData(), "")
+
+    def test_negotiate_json(self):
+        ch = ConnectionHandle(None, None)
+        ch.addInData('{"id": "1"}')
+        self.assertEqual(negotiate(ch), (ConnectionHandle.OK, [{"id": "1"}]))
+
+
+if __name__ == "__main__":
+    main()
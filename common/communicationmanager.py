@@ -68,6 +68,8 @@ import os.path
 import sys
 import errno
 import bdb
+import collections
+import itertools
 
 import pprint
 
@@ -80,8 +82,17 @@ class ConnectionHandle(object):
         This class in only needed for the default communication manager, 
         the Qt ones has it's own mechanism.        
         
-        Operations on buffers run as FIFO.
+        Operations on buffers run as FIFO. The out buffer is a queue of the
+        added strings, which are neither concatenated nor copied until they
+        are written. The in buffer is a bytearray filled in place by
+        recv_into, and only grows when a read doesn't fit in it.
     """
+
+    WRITE_SIZE = 65536
+    """ Small chunks are joined up to this size for one write call """
+    READ_SIZE = 4096
+    """ Initial size of the in buffer """
+
     def __init__(self, cm, socket, protoIn=None, protoOut=None, ssl=False):
         """
             Create a new Connection Handle. The specific protocol callback will
@@ -96,13 +107,22 @@ class ConnectionHandle(object):
         self.cm = cm
         self.socket = socket
         self.isInPollList = False
+        # the events registered in the poller, see CommunicationManager._managePollList
+        self.registeredFor = 0
         # We must poll for something, else the connection will be considered finished
-        self.pollFor = select.POLLIN
+        # (not through the property: the handle is not managed yet)
+        self._pollFor = select.POLLIN
         self.listening = False
         self.connecting = False
         self.dontClose = False # set it to true if the socket should live after a disconnection. It won't be managed anymore by the connection manager.
-        self.inData = ""
-        self.outData = ""
+        # the in buffer: inBuffer[inStart:inEnd]
+        self.inBuffer = bytearray(self.READ_SIZE)
+        self.inStart = 0
+        self.inEnd = 0
+        # the out buffer: outChunks without the outOffset first bytes
+        self.outChunks = collections.deque()
+        self.outOffset = 0
+        self.outLen = 0
         self.protoIn = protoIn
         self.protoOut = protoOut
         self.semaOut = threading.Semaphore()
@@ -110,6 +130,18 @@ class ConnectionHandle(object):
         self.hold = False
         self.readUntil = 0
 
+    def _getPollFor(self):
+        return self._pollFor
+
+    def _setPollFor(self, pollFor):
+        if pollFor != self._pollFor:
+            self._pollFor = pollFor
+            self.cm.changedChs.add(self)
+
+    pollFor = property(_getPollFor, _setPollFor, doc="""
+        The events to poll for. Changing them queues the handle for a
+        registration update at the next loop turn.""")
+
     def getOutData(self):
         """
             @return: a copy of all data in the out buffer. Data has not been
@@ -118,10 +150,41 @@ class ConnectionHandle(object):
             Thread-safe.
         """
         self.semaOut.acquire()
-        data = str(self.outData)
+        data = "".join(self.outChunks)[self.outOffset:]
         self.semaOut.release()
         return data
 
+    def peekOutData(self):
+        """
+            @return: the next data to write, without copy when it is in one
+            chunk: a buffer on the first chunk, or small chunks joined up to
+            WRITE_SIZE bytes.
+
+            Thread-safe.
+        """
+        self.semaOut.acquire()
+        if not self.outChunks:
+            data = ""
+        elif len(self.outChunks) == 1 or len(self.outChunks[0]) - self.outOffset >= self.WRITE_SIZE:
+            data = buffer(self.outChunks[0], self.outOffset, self.WRITE_SIZE)
+        else:
+            parts = [self.outChunks[0][self.outOffset:]]
+            size = len(parts[0])
+            for chunk in itertools.islice(self.outChunks, 1, None):
+                if size + len(chunk) > self.WRITE_SIZE:
+                    break
+                parts.append(chunk)
+                size += len(chunk)
+            data = "".join(parts)
+        self.semaOut.release()
+        return data
+
+    def getOutDataLen(self):
+        """
+            @return: the number of bytes waiting in the out buffer
+        """
+        return self.outLen
+
     def removeOutData(self, howMany):
         """
             Clear part of the out buffer. If no more data is present, the pollout
@@ -133,8 +196,12 @@ class ConnectionHandle(object):
         """
     
         self.semaOut.acquire()
-        self.outData = self.outData[howMany:]
-        if len(self.outData) == 0 :
+        self.outLen -= howMany
+        howMany += self.outOffset
+        while self.outChunks and howMany >= len(self.outChunks[0]):
+            howMany -= len(self.outChunks.popleft())
+        self.outOffset = howMany if self.outChunks else 0
+        if self.outLen == 0 :
             self.pollFor &= ~select.POLLOUT
         self.semaOut.release()
 
@@ -145,13 +212,18 @@ class ConnectionHandle(object):
             
             Thread-safe
             
-            @param data: a string of bytes
+            @param data: a string of bytes. Other buffers (bytearray) are
+            copied since they may change before being sent.
             @return: the number of bytes in the buffer
         """
+        if type(data) is not str:
+            data = str(data)
         self.semaOut.acquire()
         self.pollFor |= select.POLLOUT
-        self.outData += data
-        result = len(self.outData)
+        if data:
+            self.outChunks.append(data)
+            self.outLen += len(data)
+        result = self.outLen
         self.semaOut.release()
         self.cm._wakeup("Alerts poll that new data are ready to be sent on socket %d" % self.sid())
         return result
@@ -161,8 +233,17 @@ class ConnectionHandle(object):
     def getInData(self):
         """
             Get input data. Data stays in the buffer.
+            @return: a copy of the data, as a string
         """
-        return self.inData
+        return str(buffer(self.inBuffer, self.inStart, self.inEnd - self.inStart))
+
+    def getInBuffer(self):
+        """
+            Get input data without copy. Data stays in the buffer.
+            @return: (buffer, start, end), the data being buffer[start:end].
+            buffer is a bytearray, only valid until the next read.
+        """
+        return self.inBuffer, self.inStart, self.inEnd
 
     def clearInData(self, howMany=None):
         """
@@ -171,15 +252,48 @@ class ConnectionHandle(object):
             all data.
         """
         if howMany == None:
-            self.inData = ""
+            self.inStart = self.inEnd
         else :
-            self.inData = self.inData[howMany:]
+            self.inStart = min(self.inStart + howMany, self.inEnd)
+        if self.inStart == self.inEnd:
+            self.inStart = self.inEnd = 0
+
+    def reserveInData(self, size):
+        """
+            Make room for size more bytes at the end of the in buffer, moving
+            the data at its start or growing it if needed.
+        """
+        if len(self.inBuffer) - self.inEnd >= size:
+            return
+        length = self.inEnd - self.inStart
+        if length + size <= len(self.inBuffer):
+            ## copied first: the moved data may overlap its destination
+            self.inBuffer[:length] = self.inBuffer[self.inStart:self.inEnd]
+        else:
+            grown = bytearray(max(2 * len(self.inBuffer), length + size))
+            grown[:length] = buffer(self.inBuffer, self.inStart, length)
+            self.inBuffer = grown
+        self.inStart = 0
+        self.inEnd = length
 
     def addInData(self, data):
         """
             Add data which has just be read. Only used by CommunicationManager.
         """
-        self.inData += data
+        self.reserveInData(len(data))
+        self.inBuffer[self.inEnd:self.inEnd + len(data)] = data
+        self.inEnd += len(data)
+
+    def recvInData(self, size):
+        """
+            Read at most size bytes from the socket into the in buffer. Only
+            used by CommunicationManager.
+            @return: the number of bytes read, 0 if the socket has been closed
+        """
+        self.reserveInData(size)
+        count = self.socket.recv_into(memoryview(self.inBuffer)[self.inEnd:], size)
+        self.inEnd += count
+        return count
 
     def sid(self):
         """
@@ -259,7 +373,7 @@ class CommunicationManager(object):
         messages.
     """
     
-    def __init__(self, blocking=True, protoIn=None, protoOut=None):
+    def __init__(self, blocking=True, protoIn=None, protoOut=None, poller=None):
         """
             Create a communication manager.
             
@@ -283,6 +397,8 @@ class CommunicationManager(object):
             one string with the value converted.
             Default is a callback calling str() on each object, concatenating them.
             
+            @param poller: the poller class (see PollPoller). Default to
+            EpollPoller when available (Linux), else to PollPoller.
         """
     
         self.lowLevelListeners = []
@@ -290,11 +406,15 @@ class CommunicationManager(object):
         self.semaChs = threading.Semaphore()
         self.semaChs.acquire()
         self.chs = {}
+        # handles whose pollFor changed since the last loop turn
+        self.changedChs = set()
         self.stopOnExceptionFlag = False
         self.stopOnKeyboardInterruptFlag = True
-        self.poll = select.poll()
+        self.poll = (poller or DefaultPoller)()
         self.running = True
         self.connectionCount = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
         self.wakeupPipe = os.pipe()
         self.timeouts = TimeoutsManagement()
         self.poll.register(self.wakeupPipe[0], select.POLLIN)
@@ -324,22 +444,36 @@ class CommunicationManager(object):
 
     def _managePollList(self):
         """
-            Manage all the connections in the polling object. 
+            Update the polling object registrations of the connections whose
+            pollFor changed since the last turn.
             If an object polls for nothing, it is removed. 
         """
         chToRelease = []
         self.semaChs.acquire()
-        for ch in self.chs.values():
-            if ch.pollFor == 0:
+        ## pop() is atomic: handles changed by other threads meanwhile are
+        ## either treated now or kept for the next turn
+        while self.changedChs:
+            ch = self.changedChs.pop()
+            try:
+                if self.chs.get(ch.sid()) is not ch:
+                    continue ## not managed yet, or already released
+            except socket.error:
+                continue ## closed socket
+            pollFor = ch.pollFor
+            if pollFor == 0:
                 if ch.isInPollList:
-                    self.poll.unregister(ch.socket)
+                    self.poll.unregister(ch.sid())
                     ch.isInPollList = False
+                    ch.registeredFor = 0
                 if not ch.hold:
                     chToRelease.append(ch)
-
-            if ch.pollFor != 0:
-                self.poll.register(ch.socket, ch.pollFor)
+            elif not ch.isInPollList:
+                self.poll.register(ch.sid(), pollFor)
                 ch.isInPollList = True
+                ch.registeredFor = pollFor
+            elif pollFor != ch.registeredFor:
+                self.poll.modify(ch.sid(), pollFor)
+                ch.registeredFor = pollFor
         self.semaChs.release()
         for ch in chToRelease:
             self._releaseSocket(ch)
@@ -393,7 +527,8 @@ class CommunicationManager(object):
             Try reading socket. Close it properly if
             needed.
         """
-        sizeToRead = ch.readUntil if ch.readUntil != 0 else 4096 
+        sizeToRead = ch.readUntil if ch.readUntil != 0 else ch.READ_SIZE
+        data = None ## socket data is read in place, see ConnectionHandle.recvInData
         try:
             if ch.ssl:
                 data = ""
@@ -405,7 +540,7 @@ class CommunicationManager(object):
                     if error[0] != errno.ENOENT: #EWOULDBLOCK
                         raise
             else:
-                data = ch.socket.recv(sizeToRead)
+                count = ch.recvInData(sizeToRead)
         except socket.error, error:
             self._manageErroneousConnection(ch, error[0])
             return
@@ -425,21 +560,28 @@ class CommunicationManager(object):
             except IOError, e:
                 self.manageErroneousConnection(ch, e)
                 
-        if ch.readUntil != 0 and len(data) == ch.readUntil and not ch.ssl:
+        if data is not None:
+            count = len(data)
+        if ch.readUntil != 0 and count == ch.readUntil and not ch.ssl:
             self.hold(ch.sid())
 
-        if data == "" : ## socket has been properly closed
+        if count == 0 : ## socket has been properly closed
             ch.pollFor &= ~select.POLLIN ## nothing more to read.
         else :
-            self._throwLowLevelEvent((ch.sid(), "READ", str(data)))
-            ch.addInData(data)
+            self.bytesIn += count
+            if data is None:
+                data = buffer(ch.inBuffer, ch.inEnd - count, count)
+            else:
+                ch.addInData(data)
+            if self.lowLevelListeners:
+                self._throwLowLevelEvent((ch.sid(), "READ", str(data)))
             self._manageInData(ch)
 
     def _writeSocket(self, ch):
         """
             Try writing the socket.
         """
-        data = ch.getOutData()
+        data = ch.peekOutData()
         try:
             if ch.ssl:
                 sentLen = ch.socket.write(data)
@@ -447,12 +589,21 @@ class CommunicationManager(object):
                 sentLen = ch.socket.send(data)
         except AttributeError:
             ## socket is a FD
-            sentLen = os.write(ch.socket, data)
+            try:
+                sentLen = os.write(ch.socket, data)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    self._manageErroneousConnection(ch, e.errno)
+                    return
+                ## a non blocking pipe may refuse a write bigger than its free space
+                sentLen = 0
         except socket.error, error:
             self._manageErroneousConnection(ch, error[0])
             return
         ch.removeOutData(sentLen)
-        self._throwLowLevelEvent((ch.sid(), "WRITE", str(data[:sentLen])))
+        self.bytesOut += sentLen
+        if self.lowLevelListeners:
+            self._throwLowLevelEvent((ch.sid(), "WRITE", str(data[:sentLen])))
 
     def send(self, cid, data):
         """
@@ -473,6 +624,12 @@ class CommunicationManager(object):
         ch = self._cidToCh(cid)
         return ch.addOutData(data)
 
+    def outDataLen(self, cid):
+        """
+            @return: the number of bytes not yet sent on a connection
+        """
+        return self._cidToCh(cid).getOutDataLen()
+
     def _createConnectedSocket(self, ch):
         """
             Given a connection handle which should have a pending connection,
@@ -487,7 +644,7 @@ class CommunicationManager(object):
         connection = ch.socket.accept()
         nch = ConnectionHandle(self, socket=connection[0], protoIn=ch.protoIn, protoOut=ch.protoOut, ssl=ch.ssl) 
         nch.socket.setblocking(False)
-        self.chs[nch.sid()] = nch
+        self._addHandle(nch)
         self._throwLowLevelEvent((nch.sid(), "NEW CONNECTION", connection[1], nch.socket.getsockname()))
         self._throwHighLevelEvent(("incoming connection", nch.sid()))
         # we are now ready to accept incoming data
@@ -511,7 +668,7 @@ class CommunicationManager(object):
         """
         ch.pollFor |= select.POLLIN
         ## POLLOUT was needed for connection completion, so it is already set
-        if len(ch.getOutData()) == 0:
+        if ch.getOutDataLen() == 0:
             ch.pollFor &= ~select.POLLOUT
         if ch.ssl:
             try:
@@ -537,7 +694,11 @@ class CommunicationManager(object):
         if ch.pollFor == 0: # already managed
             return
         if error == None:
-            error = ch.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            try:
+                error = ch.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            except AttributeError:
+                ## socket is a FD, POLLERR on a pipe means the reader is gone
+                error = errno.EPIPE
         if error != 0:
             self._throwLowLevelEvent((ch.sid(), "ERROR", error, errno.errorcode[error], os.strerror(error)))
             self._throwHighLevelEvent(("connection error", ch.sid(), os.strerror(error)))
@@ -627,6 +788,7 @@ class CommunicationManager(object):
         self._throwLowLevelEvent((None, "MAIN LOOP STARTED"))
         while self.loop():
             pass 
+        self.poll.close()
         self._throwLowLevelEvent((None, "MAIN LOOP STOPPED"))
 
     def stop(self):
@@ -702,7 +864,7 @@ class CommunicationManager(object):
         ch.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
         ch.socket.listen(5)
         self.semaChs.acquire()
-        self.chs[ch.sid()] = ch
+        self._addHandle(ch)
         self._throwLowLevelEvent((ch.sid(), "LISTENING", portOrAddress))
         self._throwHighLevelEvent(("listening", ch.sid()))
         ch.pollFor = select.POLLIN
@@ -712,6 +874,14 @@ class CommunicationManager(object):
         self.semaChs.release()
         return ch.sid()
 
+    def _addHandle(self, ch):
+        """
+            Manage a connection handle. Its registration is done at the next
+            loop turn.
+        """
+        self.chs[ch.sid()] = ch
+        self.changedChs.add(ch)
+
     def _cidToCh(self, cid):
         try:
             return self.chs[cid]
@@ -727,6 +897,8 @@ class CommunicationManager(object):
         ch = self._cidToCh(cid)
         ch.hold = False
         ch.pollFor &= ~select.POLLIN
+        ## a hold handle may already poll for nothing: release it anyway
+        self.changedChs.add(ch)
         self._throwLowLevelEvent((ch.sid(), "DISCONNECTING"))
         self._wakeup("Alerts poll that socket %d is no more active" % ch.sid())
 
@@ -824,7 +996,7 @@ class CommunicationManager(object):
 
     def _addSocket(self, ch, address):
         self.semaChs.acquire()
-        self.chs[ch.sid()] = ch
+        self._addHandle(ch)
         self._throwLowLevelEvent((ch.sid(), "CONNECTING", address, ch.socket.getsockname()))
         ch.connecting = True
         ch.pollFor |= select.POLLOUT
@@ -901,7 +1073,7 @@ class CommunicationManager(object):
         ch = ConnectionHandle(self, fd, protoIn, protoOut)
         ch.dontClose = dontClose
         self.semaChs.acquire()
-        self.chs[ch.sid()] = ch
+        self._addHandle(ch)
         self._throwLowLevelEvent((ch.sid(), "FD ADDED"))
         self._throwHighLevelEvent(("file descriptor managed", ch.sid()))
         self.connectionCount += 1
@@ -943,6 +1115,83 @@ class CommunicationManager(object):
         self.timeouts.cancelTimeout(handle)
         self._throwLowLevelEvent((None, "TIMEOUT CANCELED", handle))
 
+class PollPoller(object):
+    """
+        Poller backend using poll(2). This is the interface of the pollers:
+        registrations are kept between calls to poll and only changed through
+        register, modify and unregister.
+    """
+    def __init__(self):
+        self.poller = select.poll()
+
+    def register(self, fd, events):
+        """
+            @param events: ORed select.POLL* flags
+        """
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        """
+            @param timeout: in milliseconds, None to wait forever
+            @return: a list of (fd, events)
+        """
+        return self.poller.poll(timeout)
+
+    def close(self):
+        pass
+
+
+class EpollPoller(PollPoller):
+    """
+        Poller backend using epoll(7) (Linux only): the cost of a poll call
+        depends on the ready descriptors, not on the registered ones. epoll
+        and poll event flags share their values on Linux.
+        
+        Regular files can't be registered in an epoll set. As poll does, they
+        are reported ready at each call.
+    """
+    def __init__(self):
+        self.poller = select.epoll()
+        self.files = {}
+
+    def register(self, fd, events):
+        try:
+            self.poller.register(fd, events)
+        except IOError, e:
+            if e.errno != errno.EPERM:
+                raise
+            self.files[fd] = events
+
+    def modify(self, fd, events):
+        if fd in self.files:
+            self.files[fd] = events
+        else:
+            self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        if self.files.pop(fd, None) is None:
+            self.poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        if self.files:
+            timeout = 0
+        result = self.poller.poll(-1 if timeout is None else timeout / 1000.0)
+        if self.files:
+            result.extend(self.files.items())
+        return result
+
+    def close(self):
+        self.poller.close()
+
+DefaultPoller = EpollPoller if hasattr(select, "epoll") else PollPoller
+
+
 class TimeoutsManagement(object):
     def __init__(self):
         self.pendings = []
@@ -989,7 +1238,8 @@ class TimeoutsManagement(object):
         if len(self.pendings) == 0:
             return None
         now = time.time()
-        return (self.pendings[0]["time"] - now) * 1000
+        ## a negative timeout would make poll wait forever
+        return max(0, (self.pendings[0]["time"] - now) * 1000)
     
     def popPastEvents(self):
         """
@@ -1049,11 +1299,202 @@ def allLevelListener(event):
     pprint.pprint(event)
     #sys.excepthook(*event[2])
 
+from unittest import TestCase
+from unittest import main
+import tempfile
+
+def recordingPoller(poller):
+    """
+        @return: a subclass of the poller class recording the registration
+        changes in its calls list
+    """
+    class RecordingPoller(poller):
+        def __init__(self):
+            poller.__init__(self)
+            self.calls = []
+
+        def register(self, fd, events):
+            self.calls.append(("register", fd, events))
+            poller.register(self, fd, events)
+
+        def modify(self, fd, events):
+            self.calls.append(("modify", fd, events))
+            poller.modify(self, fd, events)
+
+        def unregister(self, fd):
+            self.calls.append(("unregister", fd))
+            poller.unregister(self, fd)
+
+    return RecordingPoller
+
+class ConnectionHandleTest(TestCase):
+
+    def setUp(self):
+        self.cm = CommunicationManager(poller=PollPoller)
+        self.pipe = os.pipe()
+        self.ch = ConnectionHandle(self.cm, self.pipe[1])
+
+    def tearDown(self):
+        for fd in self.pipe + self.cm.wakeupPipe:
+            os.close(fd)
+
+    def test_out_chunks(self):
+        ch = self.ch
+        ch.WRITE_SIZE = 8
+        for data in ("abc", bytearray("defg"), "", "hijklmnopq"):
+            ch.addOutData(data)
+        self.assertEqual((ch.getOutData(), ch.getOutDataLen()), ("abcdefghijklmnopq", 17))
+        self.assertEqual(str(ch.peekOutData()), "abcdefg")
+        ch.removeOutData(5)
+        self.assertEqual((str(ch.peekOutData()), ch.getOutData()), ("fg", "fghijklmnopq"))
+        ch.removeOutData(2)
+        self.assertEqual(str(ch.peekOutData()), "hijklmno")
+        ch.removeOutData(10)
+        self.assertEqual((ch.getOutData(), ch.outOffset, ch.pollFor & select.POLLOUT), ("", 0, 0))
+
+    def test_repeated_chunks(self):
+        ch = self.ch
+        ch.WRITE_SIZE = 8
+        for i in range(4):
+            ch.addOutData("ab")
+        self.assertEqual(str(ch.peekOutData()), "abababab")
+
+    def test_in_buffer(self):
+        ch = self.ch
+        ch.inBuffer = bytearray(4)
+        ch.addInData("abc")
+        ch.clearInData(2)
+        ch.addInData("de")
+        self.assertEqual((len(ch.inBuffer), ch.getInData()), (4, "cde"))
+        ch.addInData("fghij")
+        self.assertEqual((len(ch.inBuffer), ch.getInBuffer()[1:], ch.getInData()), (8, (0, 8), "cdefghij"))
+        ch.clearInData()
+        self.assertEqual(ch.getInBuffer()[1:], (0, 0))
+
+class PollerTests(object):
+    """
+        Registrations of a poller backend, run through a communication
+        manager on a real socket pair. Subclasses set the poller class.
+    """
+    poller = None
+
+    def setUp(self):
+        self.cm = CommunicationManager(poller=recordingPoller(self.poller))
+        self.calls = self.cm.poll.calls
+        ## only the connection registrations are checked
+        del self.calls[:]
+        self.events = []
+        self.cm.registerHighLevelListener(self.events.append)
+        self.local, self.remote = socket.socketpair()
+        self.local.setblocking(0)
+        ch = ConnectionHandle(self.cm, self.local)
+        self.cm._addHandle(ch)
+        self.cm.connectionCount += 1
+        self.cid = ch.sid()
+        self.turn()
+
+    def tearDown(self):
+        self.remote.close()
+        if self.cid in self.cm.chs:
+            self.local.close()
+        self.cm.poll.close()
+        for fd in self.cm.wakeupPipe:
+            os.close(fd)
+
+    def turn(self, count=3):
+        """
+            Run a few loop turns, none waiting more than 10 ms.
+        """
+        for i in range(count):
+            self.cm.setTimeout(0.01)
+            self.cm.loop()
+        self.cm._managePollList()
+
+    def packets(self):
+        return [event[2] for event in self.events if event[0] == "packet"]
+
+    def test_registrations(self):
+        self.assertEqual(self.calls, [("register", self.cid, select.POLLIN)])
+        del self.calls[:]
+
+        self.cm.sendRaw(self.cid, "abc")
+        self.turn()
+        self.assertEqual(self.remote.recv(16), "abc")
+        self.assertEqual(self.calls, [
+            ("modify", self.cid, select.POLLIN | select.POLLOUT),
+            ("modify", self.cid, select.POLLIN),
+        ])
+        del self.calls[:]
+
+        self.remote.send("def")
+        self.turn()
+        self.assertEqual(self.packets(), ["def"])
+        ## nothing changed: no registration call
+        self.assertEqual(self.calls, [])
+
+    def test_hold(self):
+        del self.calls[:]
+        self.cm.hold(self.cid)
+        self.remote.send("abc")
+        self.turn()
+        self.assertEqual(self.packets(), [])
+        self.assertEqual(self.calls, [("unregister", self.cid)])
+        self.assertTrue(self.cid in self.cm.chs)
+        del self.calls[:]
+
+        self.cm.unhold(self.cid)
+        self.turn()
+        self.assertEqual(self.packets(), ["abc"])
+        self.assertEqual(self.calls, [("register", self.cid, select.POLLIN)])
+
+    def test_disconnect_hold(self):
+        self.cm.hold(self.cid)
+        self.turn()
+        del self.calls[:]
+        self.cm.disconnect(self.cid)
+        self.turn()
+        self.assertEqual(self.calls, [])
+        self.assertFalse(self.cid in self.cm.chs)
+        self.assertTrue(("connection closed", self.cid) in self.events)
+        self.assertEqual(self.cm.connectionCount, 0)
+        self.assertEqual(self.remote.recv(16), "")
+
+    def test_regular_file(self):
+        f = tempfile.TemporaryFile()
+        try:
+            f.write("data")
+            f.flush()
+            f.seek(0)
+            fd = self.cm.addFDescriptor(f.fileno())
+            self.cm._managePollList()
+            if hasattr(self.cm.poll, "files"):
+                ## EPERM: kept out of the epoll set, and reported ready
+                self.assertEqual(self.cm.poll.files, {fd: select.POLLIN})
+                self.assertTrue((fd, select.POLLIN) in self.cm.poll.poll(None))
+            self.turn()
+            self.assertEqual(self.packets(), ["data"])
+            ## read until EOF, then unmanaged
+            self.assertTrue(("file descriptor unmanaged", fd) in self.events)
+            self.assertFalse(fd in self.cm.chs)
+            self.assertEqual(self.calls[-2:], [("register", fd, select.POLLIN), ("unregister", fd)])
+            self.assertEqual(getattr(self.cm.poll, "files", {}), {})
+        finally:
+            f.close()
+
+class PollPollerTest(PollerTests, TestCase):
+    poller = PollPoller
+
+if hasattr(select, "epoll"):
+    class EpollPollerTest(PollerTests, TestCase):
+        poller = EpollPoller
+
+
 ## Running the module should'n raise any exception. It should test most features
 ## but is not considered a real test case since received events are not
 ## checked.
 if __name__ == "__main__" :
-    com = CommunicationManager(blocking=False)
+    ## the fd numbers below are those given without an epoll fd
+    com = CommunicationManager(blocking=False, poller=PollPoller)
     com.registerLowLevelListener(allLevelListener)
     com.registerHighLevelListener(allLevelListener)
     try :
@@ -1094,3 +1535,5 @@ if __name__ == "__main__" :
         sys.excepthook(*sys.exc_info())
     com.stop()
 
+    main()
+
@@ -15,9 +15,19 @@ class CommunicationManagerHandler(object):
     def onEvent(self, event):
         if event[0] == "packet":
             r = self.handleRequest(event[2], event[1])
-            self.com.send(event[1], r)
+            if r is not None:
+                self.com.send(event[1], r)
 
     def handleRequest(self, request, cid):
+        """
+            Call the request_type handler of the request.
+
+            A handler may return a future, or a coroutine when the manager
+            runs on an event loop (see AsyncioCommunicationManager). The
+            answer is then sent when it is done, and None is returned.
+
+            @return: the answer
+        """
         try:
             rid = request["id"]
         except (KeyError, TypeError):
@@ -25,23 +35,44 @@ class CommunicationManagerHandler(object):
 
         try:
             r = {"id": rid}
-            self.request_type[request["request"]](self, request, cid, r)
-        except KeyError, e:
+            pending = self.request_type[request["request"]](self, request, cid, r)
+        except Exception, e:
+            return self.requestError(rid, e)
+
+        if pending is None:
+            return r
+        if not hasattr(pending, "add_done_callback"):
+            pending = self.com.ensureFuture(pending)
+        pending.add_done_callback(lambda future: self.requestDone(future, cid, r))
+        return None
+
+    def requestDone(self, future, cid, r):
+        """
+            Send the answer of a request whose handler returned a future.
+        """
+        try:
+            future.result()
+        except Exception, e:
+            r = self.requestError(r["id"], e)
+        self.com.send(cid, r)
+
+    def requestError(self, rid, e):
+        """
+            @return: the answer to a request whose handler raised e
+        """
+        if isinstance(e, KeyError):
             return {
                 "id": rid,
                 "error": "Protocol error, missing key: %s" % e.args[0],
             }
-        except ValueError, e:
+        elif isinstance(e, ValueError):
             return {
                 "id": rid,
                 "error": "Value error: %s" % e.args[0],
             }
-        except Exception, e:
-            return {
-                "id": rid,
-                "error": "Exception: %s %s" % (e, e.args[0]),
-            }
-
-        return r
+        return {
+            "id": rid,
+            "error": "Exception: %s %s" % (e, e.args[0]),
+        }
 
 
@@ -2,6 +2,7 @@
 import sys, os
 sys.path.append(os.path.join(".."))
 
+import re
 import json
 
 from common.communicationmanager import ConnectionHandle
@@ -18,8 +19,14 @@ class JsonProtocol(object):
         "[": "]",
     }
 
+    ## the only characters changing the parser state
+    special = re.compile(r'[\[\]{}"\\]')
+
     def __init__(self):
         self.buffer = ""
+        self.reset()
+
+    def reset(self):
         self.cur = 0
         self.stack = []
         self.string = False
@@ -27,48 +34,64 @@ class JsonProtocol(object):
     
     def parse(self, data):
         self.buffer += data
+        r, consumed = self.parseBuffer(self.buffer, 0, len(self.buffer))
+        self.buffer = self.buffer[consumed:] if r[0] != GARBAGE else ""
+        return r
+
+    def parseBuffer(self, buffer, start, end):
+        """
+            Parse buffer[start:end] in place. The bytes which are not consumed
+            must be given again, followed by the new ones, at the next call.
+            @param buffer: a string or a bytearray
+            @return: ((status, documents), number of bytes consumed)
+        """
         docs = []
-        remove_cur = 0
-        buffer = self.buffer
-        max_cur = len(buffer)
-        while self.cur < max_cur:
-            char = buffer[self.cur]
+        remove_cur = start
+        begin_cur = start + self.begin_cur
+        cur = start + self.cur
+        search = self.special.search
+        while cur < end:
+            match = search(buffer, cur, end)
+            if match is None:
+                cur = end
+                break
+            cur = match.start()
+            char = str(match.group())
             if self.string:
                 if char == '\\':
-                    self.cur += 1
+                    cur += 1
                 elif char == '"':
                     self.string = False
             else:
-                if char in self.delimiters.keys():
+                if char in self.delimiters:
                     if len(self.stack) == 0:
-                        self.begin_cur = self.cur
+                        begin_cur = cur
                     self.stack.append(char)
-                elif char in self.delimiters.values():
-                    try:
-                        if char != self.delimiters[self.stack[-1]]:
-                            return GARBAGE, []
-                    except IndexError:
-                        return GARBAGE, []
-                    self.stack.pop()
-                    if len(self.stack) == 0:
-                        docs.append(buffer[self.begin_cur: self.cur + 1])
-                        remove_cur = self.cur + 1
                 elif char == '"':
                     self.string = True
-            self.cur += 1
+                elif char != '\\':
+                    if not self.stack or char != self.delimiters[self.stack[-1]]:
+                        self.reset()
+                        return (GARBAGE, []), 0
+                    self.stack.pop()
+                    if len(self.stack) == 0:
+                        docs.append(str(buffer[begin_cur: cur + 1]))
+                        remove_cur = cur + 1
+            cur += 1
         
-        self.buffer = buffer[remove_cur:]
-        self.begin_cur -= remove_cur
-        self.cur -= remove_cur
+        self.begin_cur = begin_cur - remove_cur
+        self.cur = cur - remove_cur
+        consumed = remove_cur - start
         r = []
         if len(docs):
             try:
                 for doc in docs:
                     r.append(json.loads(doc))
             except ValueError:
-                return GARBAGE, []
-            return OK, r
-        return UNDEFINED, []
+                self.reset()
+                return (GARBAGE, []), consumed
+            return (OK, r), consumed
+        return (UNDEFINED, []), consumed
 
 def zapFirstArg(f):
     def zapFirstArgWorker(a, *arg, **kwargs):
@@ -83,8 +106,8 @@ rc = {
 
 def feedData(p):
     def feedDataWorker(ch):
-        r = p.parse(ch.getInData())
-        ch.clearInData()
+        r, consumed = p.parseBuffer(*ch.getInBuffer())
+        ch.clearInData(consumed)
         return (rc[r[0]], r[1])
     return feedDataWorker
 
@@ -144,6 +167,28 @@ class JsonProtocolTest(TestCase):
         r = jp.parse("")
         self.assertEqual(r, (UNDEFINED, []))
 
+    def test_escape(self):
+        jp = JsonProtocol()
+        r = jp.parse('{"a": "\\')
+        self.assertEqual(r, (UNDEFINED, []))
+        r = jp.parse('"}"} [')
+        self.assertEqual(r, (OK, [{"a": '"}'}]))
+
+    def test_connection_buffer(self):
+        ch = ConnectionHandle(None, None)
+        proto = feedData(JsonProtocol())
+        ch.addInData('{"a": [1, "]"]}{"b"')
+        self.assertEqual(proto(ch), (ConnectionHandle.OK, [{"a": [1, "]"]}]))
+        self.assertEqual(ch.getInData(), '{"b"')
+        ch.addInData(': 2}')
+        self.assertEqual(proto(ch), (ConnectionHandle.OK, [{"b": 2}]))
+        self.assertEqual(ch.getInData(), "")
+        ch.addInData('}{}')
+        self.assertEqual(proto(ch), (ConnectionHandle.GARBAGE, []))
+        ch.clearInData()
+        ch.addInData('{}')
+        self.assertEqual(proto(ch), (ConnectionHandle.OK, [{}]))
+
     def test_paquet(self):
         a = """
             {
@@ -12,15 +12,27 @@
   * Reset is done via SIGUSR1, stop by SIGQUIT or SIGINT.
   * All others signals keep their default meanings.
   *
+  * Instead of stdin, frames can be read from the shared galaxy file
+  * published by the merger (see merger/sharedgalaxy.py).
+  *
   * Command line arg :
   *    (None)     : app is displaying found devices
   *    "any"      : use the first available device
   *    a serial   : app will use this device
+  *
+  *    then optionally a shared galaxy file and the univers index to send,
+  *    e.g. "any /dev/shm/llgalaxy 0"
   */
 
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
 #include <stdbool.h>
+#include <stdint.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 #include <signal.h>
 #include <pthread.h>
@@ -268,7 +280,7 @@ void readDMXFrame(void) {
     unsigned char readBuffer[513];
 
     while (i < 513) {
-        ret = read(0, readBuffer, 513 - i);
+        ret = read(0, readBuffer + i, 513 - i);
         if (ret < 0 && errno == EINTR) {
             return;
         } else if (ret < 0) {
@@ -289,6 +301,85 @@ void readDMXFrame(void) {
     }
 }
 
+/** Shared galaxy */
+
+struct galaxy_header {
+    char magic[4];
+    uint32_t version;
+    uint32_t universes;
+    volatile uint32_t sequence;
+};
+
+unsigned char * galaxy = NULL;
+unsigned char * galaxyFrame = NULL;
+
+int openGalaxy(const char * path, unsigned int univers) {
+    struct stat st;
+    struct galaxy_header * header;
+    int fd = open(path, O_RDONLY);
+
+    if (fd < 0) {
+        perror("Shared galaxy open");
+        return 1;
+    }
+    if (fstat(fd, &st) < 0) {
+        perror("Shared galaxy stat");
+        close(fd);
+        return 1;
+    }
+    if (st.st_size < sizeof(struct galaxy_header)) {
+        fprintf(stderr, "%s: not a shared galaxy file\n", path);
+        close(fd);
+        return 1;
+    }
+    galaxy = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (galaxy == MAP_FAILED) {
+        perror("Shared galaxy mmap");
+        return 1;
+    }
+
+    header = (struct galaxy_header *) galaxy;
+    if (memcmp(header->magic, "LLGX", 4) != 0 || header->version != 1) {
+        fprintf(stderr, "%s: not a shared galaxy file\n", path);
+        return 1;
+    }
+    if (univers >= header->universes) {
+        fprintf(stderr, "Univers %u is not published (%u universes)\n", univers, header->universes);
+        return 1;
+    }
+    galaxyFrame = galaxy + sizeof(struct galaxy_header) + univers * 513;
+    return 0;
+}
+
+void readSharedFrame(void) {
+    // odd sequences are never valid, so the first published frame is sent
+    static uint32_t lastSequence = 1;
+    struct galaxy_header * header = (struct galaxy_header *) galaxy;
+    unsigned char readBuffer[513];
+    uint32_t before;
+
+    before = header->sequence;
+    __sync_synchronize();
+    if ((before & 1) || before == lastSequence) {
+        usleep(1000);
+        return;
+    }
+
+    memcpy(readBuffer, galaxyFrame, 513);
+    __sync_synchronize();
+    if (header->sequence != before) {
+        // the merger was writing, retry
+        return;
+    }
+    lastSequence = before;
+
+    updateBuffer(readBuffer);
+    if (!thread_running) {
+        startThread();
+    }
+}
+
 /** Main */
 
 int main(int argc, char ** argv) {
@@ -304,10 +395,18 @@ int main(int argc, char ** argv) {
         serial = user_serial;
     }
 
+    if (argc >= 4 && openGalaxy(argv[2], atoi(argv[3]))) {
+        return 1;
+    }
+
     initSignalHandlers();
 
     while(running) {
-        readDMXFrame();
+        if (galaxy) {
+            readSharedFrame();
+        } else {
+            readDMXFrame();
+        }
     }
     return 0;
 }
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Merger benchmark.
+
+    Generates a synthetic show (universes, layers, channels, mix types,
+    16 bits channels), replays it through Merger.handleRequest and reports
+    the request throughput, the merge latency percentiles and the memory
+    used. A recorded request stream (a file of JSON requests, like
+    test_merger_input.txt) can be replayed instead.
+
+    Usage:
+        python bench_merger.py -u 8 -l 12 -c 400 -n 5000
+        python bench_merger.py --replay test_merger_input.txt
+"""
+
+import sys, os
+sys.path.append(os.path.join(".."))
+
+import time
+import random
+import resource
+import optparse
+
+from merger import Merger
+from common.jsonprotocol import JsonProtocol, OK
+
+
+def percentile(values, p):
+    """
+        @return: the p percentile (0 to 100) of a sorted list
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class Workload(object):
+    """
+        A synthetic show: a set of layers with random channels, then a stream
+        of fader moves on these channels.
+    """
+    def __init__(self, universes, layers, channels, minMax=0.2, wide=0.1, seed=0):
+        """
+            @param universes: how many universes channels are spread on
+            @param layers: the layer count
+            @param channels: the channel count per layer
+            @param minMax: the ratio of "min" and "max" mix types, the other
+            channels use float mix types
+            @param wide: the ratio of 16 bits channels
+        """
+        self.random = random.Random(seed)
+        self.universes = universes
+        self.layers = []
+        for level in range(1, layers + 1):
+            addresses = self.random.sample(xrange(1, universes * 512), min(channels, universes * 511))
+            layer = []
+            used = set()
+            for address in addresses:
+                nbChan = 2 if self.random.random() < wide else 1
+                if address in used or address + nbChan - 1 in used:
+                    continue
+                used.update(range(address, address + nbChan))
+                if self.random.random() < minMax:
+                    mixType = self.random.choice(("min", "max"))
+                else:
+                    mixType = self.random.random()
+                layer.append({
+                    "address": address,
+                    "value": self.random.randrange(256 ** nbChan),
+                    "mixType": mixType,
+                    "nbChan": nbChan,
+                })
+            self.layers.append((str(level), layer))
+
+    def setup(self):
+        """
+            @return: the requests creating the layers
+        """
+        return [
+            {"id": "l%s" % level, "request": "new layer", "layer": level, "channels": channels}
+            for level, channels in self.layers
+        ]
+
+    def faders(self, count, perRequest=1):
+        """
+            @return: count update requests, each moving perRequest channels
+            of a random layer
+        """
+        requests = []
+        for i in xrange(count):
+            level, channels = self.random.choice(self.layers)
+            moves = []
+            for channel in self.random.sample(channels, min(perRequest, len(channels))):
+                moves.append({
+                    "address": channel["address"],
+                    "value": self.random.randrange(256 ** channel["nbChan"]),
+                })
+            requests.append({"id": str(i), "request": "update channels", "layer": level, "channels": moves})
+        return requests
+
+
+def loadRequests(path):
+    """
+        Read a file of JSON requests. Quit requests are dropped.
+    """
+    status, requests = JsonProtocol().parse(open(path).read())
+    if status != OK:
+        raise ValueError("%s: no valid request" % path)
+    return [request for request in requests if request.get("request") != "quit"]
+
+
+class Bench(object):
+
+    def __init__(self, merger):
+        self.merger = merger
+        self.latencies = []
+        self.mixed = 0
+        self._timeMerges()
+
+    def _timeMerges(self):
+        latencies = self.latencies
+        for name in ("merge", "mergeDirty"):
+            method = getattr(self.merger, name)
+            def timed(method=method):
+                start = time.time()
+                method()
+                latencies.append(time.time() - start)
+            setattr(self.merger, name, timed)
+
+    def replay(self, requests):
+        """
+            @return: (elapsed time, error count)
+        """
+        errors = 0
+        handleRequest = self.merger.handleRequest
+        start = time.time()
+        for request in requests:
+            if "error" in handleRequest(request, 1):
+                errors += 1
+        return time.time() - start, errors
+
+    def fullMerges(self, count):
+        start = len(self.latencies)
+        for i in xrange(count):
+            self.merger.merge()
+        return sorted(self.latencies[start:])
+
+
+def report(name, count, elapsed, errors, latencies):
+    latencies = sorted(latencies)
+    print "%s: %d requests in %.3f s, %.0f requests/s, %d errors" % (
+        name, count, elapsed, count / elapsed if elapsed else 0, errors)
+    if latencies:
+        print "    merges: %d, latency (ms) p50 %.3f, p90 %.3f, p99 %.3f, max %.3f" % (
+            len(latencies),
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000,
+            latencies[-1] * 1000,
+        )
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-u", "--universes", type="int", default=8)
+    parser.add_option("-l", "--layers", type="int", default=12)
+    parser.add_option("-c", "--channels", type="int", default=400, help="channels per layer")
+    parser.add_option("-n", "--requests", type="int", default=5000, help="fader requests")
+    parser.add_option("-p", "--per-request", type="int", default=1, help="channels moved per fader request")
+    parser.add_option("-m", "--min-max", type="float", default=0.2, help="ratio of min/max mix types")
+    parser.add_option("-w", "--wide", type="float", default=0.1, help="ratio of 16 bits channels")
+    parser.add_option("-f", "--full-merges", type="int", default=50, help="full merges to time")
+    parser.add_option("-e", "--engine", choices=("python", "numpy"), default="python")
+    parser.add_option("-s", "--seed", type="int", default=0)
+    parser.add_option("-r", "--replay", metavar="FILE", help="replay a recorded request file instead")
+    options, args = parser.parse_args()
+
+    engine = None
+    if options.engine == "numpy":
+        from numpyengine import NumpyEngine
+        engine = NumpyEngine()
+    bench = Bench(Merger(engine=engine))
+
+    if options.replay:
+        requests = loadRequests(options.replay)
+        elapsed, errors = bench.replay(requests)
+        report("replay", len(requests), elapsed, errors, bench.latencies)
+    else:
+        workload = Workload(options.universes, options.layers, options.channels,
+            options.min_max, options.wide, options.seed)
+        requests = workload.setup()
+        elapsed, errors = bench.replay(requests)
+        report("setup", len(requests), elapsed, errors, bench.latencies)
+
+        del bench.latencies[:]
+        requests = workload.faders(options.requests, options.per_request)
+        elapsed, errors = bench.replay(requests)
+        report("faders", len(requests), elapsed, errors, bench.latencies)
+
+        latencies = bench.fullMerges(options.full_merges)
+        print "full merges (%s engine): %d channels, latency (ms) p50 %.3f, p99 %.3f" % (
+            options.engine,
+            sum(len(layer.channels) for layer in bench.merger.layers),
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+        )
+
+    print "max RSS: %d kB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+    Timed fades of channel values and mixTypes, run by the merger on its
+    frame tick (see the "fade" request).
+"""
+
+
+class Fade(object):
+    """
+        Move channels of a layer from their current value and mixType to
+        targets. Values and float mixTypes move linearly, other mixTypes
+        ("min", "max", or a float replaced by one of them) are set at the
+        end of the fade.
+    """
+    def __init__(self, rid, cid, layer, targets, duration, start):
+        """
+            @param rid: the id of the fade request, used in messages
+            @param cid: the connection to notify at the end, or None
+            @param layer: the faded layer
+            @param targets: address -> (value, mixType), None to keep the
+            current value or mixType
+            @param duration: in seconds
+            @param start: when the fade starts
+        """
+        self.rid = rid
+        self.cid = cid
+        self.layer = layer
+        self.duration = duration
+        self.start = start
+        self.done = False
+        # address -> (start value, target value, start mixType, target mixType)
+        self.channels = {}
+        for address, (value, mixType) in targets.items():
+            channel = layer.channels[address]
+            self.channels[address] = (channel.value, value, channel.mixType, mixType)
+
+    def step(self, now):
+        """
+            Compute the channel states at now. The fade is done once now is
+            past its end.
+            @return: a list of (address, value, mixType), None meaning
+            unchanged
+        """
+        if self.duration <= 0 or now >= self.start + self.duration:
+            position = 1.0
+            self.done = True
+        else:
+            position = max(0.0, (now - self.start) / self.duration)
+
+        states = []
+        for address, (fromValue, toValue, fromMix, toMix) in self.channels.items():
+            value = None
+            if toValue is not None:
+                value = int(fromValue + (toValue - fromValue) * position + 0.5)
+            mixType = None
+            if toMix is None:
+                pass
+            elif self.done:
+                mixType = toMix
+            elif type(fromMix) == type(toMix) == type(1.0):
+                mixType = fromMix + (toMix - fromMix) * position
+            states.append((address, value, mixType))
+        return states
+
+    def cancel(self, address):
+        """
+            Stop fading a channel, taken by another fade.
+        """
+        self.channels.pop(address, None)
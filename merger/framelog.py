@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    Frame logs: recordings of the frames sent by the merger.
+
+    File layout (network byte order):
+        - header: magic "LLFL", version (uint32)
+        - records: kind (uint8, KEYFRAME or DELTA), payload length (uint32),
+          time (float64), univers count (uint16), then the payload:
+            - KEYFRAME: the universes, 513 bytes each, as in a DMXGalaxy
+            - DELTA: changed ranges since the previous record, each one
+              being an offset in the concatenated universes (uint32), a
+              length (uint16) and the new bytes
+
+    A keyframe is written every keyframeInterval seconds and when the
+    univers count changes, so a reader can start from any keyframe. A
+    truncated last record (the recorder has been killed) is ignored.
+"""
+
+import os
+import mmap
+import time
+import bisect
+import struct
+import threading
+import Queue
+
+MAGIC = "LLFL"
+VERSION = 1
+HEADER = struct.Struct("!4sI")
+RECORD = struct.Struct("!BIdH")
+RANGE = struct.Struct("!IH")
+FRAME_SIZE = 513
+
+KEYFRAME = 1
+DELTA = 2
+
+## ranges are found by comparing blocks of this size
+BLOCK = 16
+MAX_RANGE = 0xffff // BLOCK * BLOCK
+
+
+def delta(old, new):
+    """
+        @param old, new: concatenated universes of the same size
+        @return: the DELTA payload turning old into new
+    """
+    parts = []
+    start = None
+    for offset in xrange(0, len(new), BLOCK):
+        changed = old[offset:offset + BLOCK] != new[offset:offset + BLOCK]
+        if start is not None and (not changed or offset - start >= MAX_RANGE):
+            parts.append(RANGE.pack(start, offset - start) + new[start:offset])
+            start = None
+        if changed and start is None:
+            start = offset
+    if start is not None:
+        parts.append(RANGE.pack(start, len(new) - start) + new[start:])
+    return "".join(parts)
+
+
+class FrameLogWriter(object):
+    """
+        Encode frames in a frame log file.
+    """
+    def __init__(self, path, keyframeInterval=1.0):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.keyframeInterval = keyframeInterval
+        self.last = None
+        self.lastKeyframe = 0
+
+    def write(self, timestamp, frames):
+        """
+            @param frames: the concatenated universes
+        """
+        count = len(frames) // FRAME_SIZE
+        if (self.last is None or len(self.last) != len(frames)
+                or timestamp - self.lastKeyframe >= self.keyframeInterval):
+            self.file.write(RECORD.pack(KEYFRAME, len(frames), timestamp, count))
+            self.file.write(frames)
+            self.lastKeyframe = timestamp
+        else:
+            payload = delta(self.last, frames)
+            self.file.write(RECORD.pack(DELTA, len(payload), timestamp, count))
+            self.file.write(payload)
+        self.last = frames
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Recorder(object):
+    """
+        Record the frames sent by the merger (see Merger.startRecording).
+
+        record() only copies the universes in a queue: the encoding and the
+        writes are done by a thread. If the thread lags too much, frames are
+        dropped instead of delaying the merger.
+    """
+
+    QUEUE_SIZE = 1024
+
+    def __init__(self, path, keyframeInterval=1.0):
+        self.writer = FrameLogWriter(path, keyframeInterval)
+        self.queue = Queue.Queue(self.QUEUE_SIZE)
+        self.last = None
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="recorder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, universes, timestamp=None):
+        """
+            Queue the universes if they changed since the last call.
+            @param universes: the univers buffers
+        """
+        frames = "".join([str(univers) for univers in universes])
+        if frames == self.last:
+            return
+        try:
+            self.queue.put_nowait((timestamp or time.time(), frames))
+        except Queue.Full:
+            self.dropped += 1
+            return
+        self.last = frames
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.writer.write(*item)
+            if self.queue.empty():
+                self.writer.flush()
+        self.writer.close()
+
+    def close(self):
+        """
+            Write the queued frames and close the file.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class FrameLogReader(object):
+    """
+        Read a frame log through a memory map: only the records being read
+        are loaded.
+    """
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size < HEADER.size:
+                raise ValueError("%s: not a frame log" % path)
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s: not a frame log" % path)
+        self.keyframes = None
+
+    def records(self, offset=HEADER.size):
+        """
+            Iterate on the record headers, from offset.
+            @return: (offset, kind, time, univers count, payload offset,
+            payload length) tuples
+        """
+        end = len(self.map)
+        while offset + RECORD.size <= end:
+            kind, length, timestamp, count = RECORD.unpack_from(self.map, offset)
+            payload = offset + RECORD.size
+            if payload + length > end:
+                return
+            yield offset, kind, timestamp, count, payload, length
+            offset = payload + length
+
+    def index(self):
+        """
+            @return: the keyframes, as a list of (time, offset), built at
+            the first call
+        """
+        if self.keyframes is None:
+            self.keyframes = [(timestamp, offset)
+                for offset, kind, timestamp, count, payload, length in self.records()
+                if kind == KEYFRAME]
+            self.times = [timestamp for timestamp, offset in self.keyframes]
+        return self.keyframes
+
+    def frames(self, start=None):
+        """
+            Iterate on the frames, from the last frame at or before start (or
+            from the first frame).
+            @return: (time, frames) tuples, frames being a bytearray of the
+            concatenated universes, updated in place between iterations
+        """
+        keyframes = self.index()
+        if not keyframes:
+            return
+        position = 0
+        if start is not None:
+            position = bisect.bisect_right(self.times, start) - 1
+            if position < 0:
+                position = 0
+                start = None
+        frames = None
+        pending = None
+        for offset, kind, timestamp, count, payload, length in self.records(keyframes[position][1]):
+            if start is not None and timestamp > start and pending is not None:
+                yield pending, frames
+                start = None
+            if kind == KEYFRAME:
+                frames = bytearray(self.map[payload:payload + length])
+            else:
+                self.applyDelta(frames, payload, length)
+            if start is None:
+                yield timestamp, frames
+            else:
+                pending = timestamp
+        if start is not None and pending is not None:
+            yield pending, frames
+
+    def applyDelta(self, frames, offset, length):
+        end = offset + length
+        while offset < end:
+            start, size = RANGE.unpack_from(self.map, offset)
+            offset += RANGE.size
+            frames[start:start + size] = self.map[offset:offset + size]
+            offset += size
+
+    def frameAt(self, timestamp):
+        """
+            @return: (time, frames) of the last frame at or before timestamp,
+            or of the first frame
+        """
+        for frame in self.frames(timestamp):
+            return frame
+        raise ValueError("Empty frame log")
+
+    def close(self):
+        self.map.close()
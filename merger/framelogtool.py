@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Inspect frame logs recorded by the merger (see framelog).
+
+    Usage:
+        python framelogtool.py summary show.fl
+        python framelogtool.py index show.fl
+        python framelogtool.py frame show.fl 12.5 [-u 0]
+
+    Times are given in seconds from the start of the recording.
+"""
+
+import time
+import optparse
+
+from framelog import FrameLogReader, KEYFRAME, FRAME_SIZE
+
+
+def summary(reader):
+    """
+        @return: a dict describing the recording
+    """
+    frames = keyframes = 0
+    first = last = None
+    universes = 0
+    size = 0
+    for offset, kind, timestamp, count, payload, length in reader.records():
+        if first is None:
+            first = timestamp
+        last = timestamp
+        frames += 1
+        if kind == KEYFRAME:
+            keyframes += 1
+        universes = max(universes, count)
+        size = payload + length
+    duration = last - first if frames else 0.0
+    return {
+        "start": first,
+        "duration": duration,
+        "frames": frames,
+        "keyframes": keyframes,
+        "universes": universes,
+        "bytes": size,
+        "frame rate": (frames - 1) / duration if duration else 0.0,
+        "bytes per frame": float(size) / frames if frames else 0.0,
+    }
+
+
+def printSummary(reader):
+    data = summary(reader)
+    if data["start"] is not None:
+        print "start: %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(data["start"]))
+    print "duration: %.3f s" % data["duration"]
+    print "frames: %d (%d keyframes), %.1f frames/s" % (data["frames"], data["keyframes"], data["frame rate"])
+    print "universes: %d" % data["universes"]
+    print "size: %d bytes, %.1f bytes/frame" % (data["bytes"], data["bytes per frame"])
+
+
+def printIndex(reader):
+    keyframes = reader.index()
+    if not keyframes:
+        return
+    start = keyframes[0][0]
+    for timestamp, offset in keyframes:
+        print "%10.3f %12d" % (timestamp - start, offset)
+
+
+def printFrame(reader, at, univers):
+    keyframes = reader.index()
+    if not keyframes:
+        raise ValueError("Empty frame log")
+    start = keyframes[0][0]
+    timestamp, frames = reader.frameAt(start + at)
+    print "frame at %.3f s" % (timestamp - start)
+    base = univers * FRAME_SIZE
+    values = list(frames[base + 1:base + FRAME_SIZE])
+    if not values:
+        raise ValueError("Univers not recorded: %s" % univers)
+    for line in range(0, len(values), 16):
+        print "%4d: %s" % (univers * 512 + line + 1, " ".join(["%3d" % v for v in values[line:line + 16]]))
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog summary|index|frame LOG [TIME]")
+    parser.add_option("-u", "--univers", type="int", default=0, help="univers printed by frame")
+    options, args = parser.parse_args()
+    if len(args) < 2 or args[0] not in ("summary", "index", "frame"):
+        parser.error("bad command")
+
+    reader = FrameLogReader(args[1])
+    try:
+        if args[0] == "summary":
+            printSummary(reader)
+        elif args[0] == "index":
+            printIndex(reader)
+        else:
+            if len(args) != 3:
+                parser.error("frame needs a time")
+            printFrame(reader, float(args[2]), options.univers)
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
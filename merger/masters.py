@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    Master groups: named sets of channels whose merged values are scaled by
+    a level, and a grand master scaling every channel (see the master
+    requests of the merger).
+
+    The merger keeps its merged galaxy unscaled and sends a scaled copy to
+    the outputs, so a level change only rescales the channels of a group,
+    without any merge.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+UNIVERS_SIZE = 512
+
+
+def checkLevel(level):
+    if not 0.0 <= level <= 1.0:
+        raise ValueError("Bad master level: %s" % level)
+    return level
+
+
+class Master(object):
+    def __init__(self, name, channels, level=1.0):
+        """
+            @param channels: address -> nbChan of the scaled channels
+            @param level: the scaling factor, between 0.0 and 1.0
+        """
+        self.name = name
+        self.channels = channels
+        self.level = checkLevel(level)
+
+
+class Masters(object):
+    """
+        The master groups of a merger, and the scaling of a galaxy by their
+        levels. A value v of a channel becomes int(v * factor + 0.5), factor
+        being the product of the grand master and of the levels of the groups
+        containing the channel. Channels wider than 8 bits are scaled as a
+        whole.
+
+        Full passes are vectorised with numpy when it is available.
+    """
+    def __init__(self):
+        # name -> Master
+        self.groups = {}
+        self.grand = 1.0
+        # address -> product of the levels of the groups containing it
+        self.factors = {}
+        # first address -> nbChan of the channels wider than 8 bits
+        self.wide = {}
+        # address -> first address of the wide channel covering it
+        self.covering = {}
+        # per univers factors, including the grand master, for numpy
+        self.arrays = None
+
+    def active(self):
+        """
+            @return: False if scaling would not change any value
+        """
+        return bool(self.groups) or self.grand != 1.0
+
+    def define(self, name, channels, level=1.0):
+        """
+            Create or replace a group.
+            @return: the addresses whose factor changed
+        """
+        addresses = set()
+        if name in self.groups:
+            addresses.update(self.groups[name].channels)
+        master = self.groups[name] = Master(name, channels, level)
+        addresses.update(master.channels)
+        self.updateWide()
+        self.refresh(addresses)
+        return addresses
+
+    def remove(self, name):
+        """
+            @return: the addresses whose factor changed
+        """
+        try:
+            master = self.groups.pop(name)
+        except KeyError:
+            raise ValueError("Unknow master: %s" % name)
+        self.updateWide()
+        self.refresh(master.channels)
+        return set(master.channels)
+
+    def setLevel(self, name, level):
+        """
+            @return: the addresses whose factor changed
+        """
+        try:
+            master = self.groups[name]
+        except KeyError:
+            raise ValueError("Unknow master: %s" % name)
+        master.level = checkLevel(level)
+        self.refresh(master.channels)
+        return set(master.channels)
+
+    def setGrand(self, level):
+        self.grand = checkLevel(level)
+        self.arrays = None
+
+    def updateWide(self):
+        self.wide = {}
+        self.covering = {}
+        for master in self.groups.values():
+            for address, nbChan in master.channels.items():
+                if nbChan > 1 and nbChan >= self.wide.get(address, 0):
+                    self.wide[address] = nbChan
+        for first, nbChan in self.wide.items():
+            for address in range(first, first + nbChan):
+                self.covering[address] = first
+
+    def refresh(self, addresses):
+        """
+            Recompute the factors of addresses.
+        """
+        for address in addresses:
+            factor = 1.0
+            for master in self.groups.values():
+                if address in master.channels:
+                    factor *= master.level
+            if factor == 1.0:
+                self.factors.pop(address, None)
+            else:
+                self.factors[address] = factor
+            if self.arrays is not None:
+                index, offset = divmod(address - 1, UNIVERS_SIZE)
+                if index < len(self.arrays):
+                    self.arrays[index][offset + 1] = self.grand * factor
+
+    def factor(self, address):
+        return self.grand * self.factors.get(address, 1.0)
+
+    def factorArrays(self, count):
+        """
+            @return: one array of factors per univers, for count universes
+        """
+        if self.arrays is None or len(self.arrays) < count:
+            self.arrays = []
+            for index in range(count):
+                factors = numpy.empty(UNIVERS_SIZE + 1)
+                factors.fill(self.grand)
+                ## start code
+                factors[0] = 1.0
+                self.arrays.append(factors)
+            for address, factor in self.factors.items():
+                index, offset = divmod(address - 1, UNIVERS_SIZE)
+                if index < count:
+                    self.arrays[index][offset + 1] = self.grand * factor
+        return self.arrays
+
+    def scale(self, source, target, addresses=None):
+        """
+            Write the scaled values of source in target.
+            @param source: the merged DMXGalaxy
+            @param target: the output DMXGalaxy
+            @param addresses: the addresses to scale, None for every address
+        """
+        if source.universes:
+            target.univers(len(source.universes) - 1)
+        if addresses is None:
+            self.scaleAll(source, target)
+            return
+
+        firsts = set()
+        for address in addresses:
+            if address in self.covering:
+                firsts.add(self.covering[address])
+            else:
+                target[address] = int(source[address] * self.factor(address) + 0.5)
+        for first in firsts:
+            self.scaleChannel(source, target, first, self.wide[first])
+
+    def scaleAll(self, source, target):
+        if numpy is not None:
+            arrays = self.factorArrays(len(source.universes))
+            for index, univers in enumerate(source.universes):
+                values = numpy.frombuffer(univers, dtype=numpy.uint8) * arrays[index] + 0.5
+                numpy.frombuffer(target.universes[index], dtype=numpy.uint8)[:] = values.astype(numpy.uint8)
+        else:
+            grand = self.grand
+            for index, univers in enumerate(source.universes):
+                target.universes[index][:] = univers
+                if grand != 1.0:
+                    target.universes[index][1:] = bytearray([int(v * grand + 0.5) for v in univers[1:]])
+            for address in self.factors:
+                target[address] = int(source[address] * self.factor(address) + 0.5)
+        for first, nbChan in self.wide.items():
+            self.scaleChannel(source, target, first, nbChan)
+
+    def scaleChannel(self, source, target, first, nbChan):
+        value = 0
+        for i in range(nbChan):
+            value = (value << 8) + source[first + i]
+        value = int(value * self.factor(first) + 0.5)
+        for i in range(nbChan):
+            target[first + (nbChan - i - 1)] = value & 255
+            value >>= 8
@@ -6,14 +6,27 @@ sys.path.append(os.path.join(".."))
 
 import sys
 import re
-
-from collections import defaultdict
+import bisect
+import time
+import math
+import optparse
+import shlex
+import struct
 
 from common.communicationmanager import CommunicationManager, allLevelListener
-from common.jsonprotocol import protoIn, protoOut
+from common.jsonprotocol import protoOut
+from common.binaryprotocol import negotiate, ChannelUpdates
 
 from common.communicationmanagerhandler import CommunicationManagerHandler
 
+from output import DriverOutput, OutputSubscription, spawnDriver
+from sharedgalaxy import SharedGalaxy
+from stats import MergerStats
+from fade import Fade
+from masters import Masters
+from snapshot import Snapshot
+from framelog import Recorder
+
 class Channel(object):
     """
         A channel is a feature channel. It describe DMX channels on
@@ -30,7 +43,11 @@ class Channel(object):
             - "max": the max between this value and the lower one
             If this channel is the lowest one, the mixtype is not used
             (defaults to 1.0).
+
+        Layers hold thousands of channels: no per instance __dict__.
     """
+    __slots__ = ("value", "mixType", "nbChan")
+
     def __init__(self, value, mixType, nbChan):
         self.value = value
         self.nbChan = nbChan
@@ -52,53 +69,51 @@ class Layer(object):
          -1 > 99
          -2 > -1
     """
+    ## __weakref__: engines cache data per layer in weak dictionaries
+    __slots__ = ("level", "key", "channels", "revision", "changedAt",
+        "status", "cid", "lid", "__weakref__")
 
     def _checkLevel(self, level):
         regexp = r"^-?\d+(\.-?\d+)*$"
         if not re.match(regexp, level):
             raise ValueError("Bad level format")
 
-    def __lt__(self, other):
-        left = self.level.split(".")
-        right = other.level.split(".")
-
-        i = 0
-        while True:
-            if i == len(left):
-                return True
-            if i == len(right):
-                return False
-
-            l = int(left[i])
-            r = int(right[i])
-
-            if (l > 0 and r > 0) or (l < 0 and r < 0):
-                l = abs(l)
-                r = abs(r)
-                if l < r:
-                    return True
-
-                if l > r:
-                    return False
-
-            if l < 0 and r > 0:
-                return False
+    def _levelKey(self, level):
+        """
+            Build the sort key of a level: each component is (0, n) when
+            positive, (1, -n) when negative, so negative components sort
+            after positive ones. A prefix sorts before longer levels.
+        """
+        key = []
+        for component in level.split("."):
+            component = int(component)
+            key.append((1, -component) if component < 0 else (0, component))
+        return tuple(key)
 
-            if l > 0 and r < 0:
-                return True
-            i += 1
+    def __lt__(self, other):
+        return self.key < other.key
 
     def __init__(self, level):
         self._checkLevel(level)
         self.level = level
+        self.key = self._levelKey(level)
 
         self.channels = {}
+        # bumped on each channel change, lets engines cache derived data
+        self.revision = 0
+        # time of the last change made through the merger, see Merger.updatePrefix
+        self.changedAt = 0
+        # "volatile" layers are removed when their connection (cid) closes
+        self.status = "volatile"
+        self.cid = None
+        # layer id, given by the merger
+        self.lid = None
 
 
     def addChannel(self, address, value, mixType=1.0, nbChan=1):
         """
             Add channel values to this layer
-            @param address: the channel address. Channels are replaced if they already exist.
+            @param address: the channel address, starting at 1. Channels are replaced if they already exist.
             @param value: the value of this channel
             @param mixType: how to compute the layer's value with the under one
                 values can be :
@@ -107,7 +122,10 @@ class Layer(object):
                     - "min", the min between this layer and the under one
                     - "max", the max between the two layers
         """
+        if address < 1:
+            raise ValueError("Bad DMX address: %d" % address)
         self.channels[address] = Channel(value, mixType, nbChan)
+        self.revision += 1
 
 
     def updateChannel(self, address, value=None, mixType=None):
@@ -118,9 +136,53 @@ class Layer(object):
             self.channels[address].value = value
         if mixType is not None:
             self.channels[address].mixType = mixType
+        self.revision += 1
 
     def delChannel(self, address):
         del self.channels[address]
+        self.revision += 1
+
+MIX = 0
+MIN = 1
+MAX = 2
+
+mixModes = {
+    "min": MIN,
+    "max": MAX,
+}
+
+## widest channel accepted in requests, in DMX channels (32 bits values)
+MAX_NB_CHAN = 4
+## default univers count of a merger: addresses beyond are rejected
+MAX_UNIVERSES = 64
+
+def parseMixType(mixType):
+    """
+        @param mixType: a mixType of a request, a number or a string
+        @return: the mixType, a finite float or a key of mixModes
+    """
+    try:
+        mixType = float(mixType)
+    except ValueError:
+        if mixType not in mixModes:
+            raise ValueError("%s: Unknow mix type" % mixType)
+        return mixType
+    if math.isinf(mixType) or math.isnan(mixType):
+        raise ValueError("%s: Unknow mix type" % mixType)
+    return mixType
+
+def parseNbChan(nbChan):
+    """
+        @return: the channel width of a request, between 1 and MAX_NB_CHAN
+    """
+    nbChan = int(nbChan)
+    if not 1 <= nbChan <= MAX_NB_CHAN:
+        raise ValueError("Bad channel width: %d" % nbChan)
+    return nbChan
+
+## sorts after every layer key
+TOP_KEY = ((2, 0),)
+
 
 class Merger(CommunicationManagerHandler):
     """
@@ -128,25 +190,156 @@ class Merger(CommunicationManagerHandler):
         values placed in channels.
         
         Most operations are available as commands sent on a unix socket. 
+
+        An engine (see numpyengine) can be given to do full merges. It must
+        produce the same galaxy as the default per channel merge.
+
+        When a communication manager and a rate (in Hz) are given, merges
+        are coalesced and run at most once per frame (see MergeScheduler).
+        Otherwise each request merges immediately.
+
+        Universes are allocated up to the highest address used, so requests
+        are limited to the first "universes" universes.
+
+        The composite of the layers that did not change for prefixDelay
+        seconds (the lowest ones, up to the first recently changed layer) is
+        cached in a prefix galaxy: incremental merges start from the prefix
+        values and only mix the channels of the layers above it.
     """
-    def __init__(self, com=None):
+
+    ## seconds without change before a layer can be part of the prefix
+    prefixDelay = 2.0
+
+    def __init__(self, com=None, engine=None, rate=None, universes=MAX_UNIVERSES):
         CommunicationManagerHandler.__init__(self, com)
+        self.engine = engine
+        self.maxUniverses = universes
+        self.scheduler = None
+        if com is not None and rate:
+            self.scheduler = MergeScheduler(com, self.frame, rate)
+        # layers, always sorted from the lowest one
         self.layers = []
+        # sort keys of self.layers, for bisection
+        self.layerKeys = []
+        # level -> layer
+        self.layerIndex = {}
+        # layer id, used by the binary protocol -> layer
+        self.layerIds = {}
+        self.nextLid = 1
+        # cid -> the volatile layers of this connection
+        self.cidLayers = {}
+        # merged values, before the masters
         self.galaxy = DMXGalaxy()
+        self.masters = Masters()
+        # the galaxy scaled by the masters, see outputGalaxy
+        self.scaled = DMXGalaxy()
+        # DMX addresses whose value must be recomputed at the next mergeDirty
+        self.dirty = set()
+        # widest channel ever seen, bounds the search for overlapping channels
+        self.maxNbChan = 1
+        # address -> mix plan of the channels starting there, see plan()
+        self.plans = {}
+        # composite of the layers whose key is below prefixKey, see updatePrefix
+        self.prefix = None
+        self.prefixKey = None
+        # next time updatePrefix looks for static layers
+        self.prefixCheck = 0
+        # fd -> DriverOutput
+        self.outputs = {}
+        # cid -> OutputSubscription
+        self.subscriptions = {}
+        # memory mapped copy of the galaxy, see exportGalaxy
+        self.sharedGalaxy = None
+        # set while a batch request runs, merges are done at its end
+        self.batching = False
+        self.stats = MergerStats()
+        # running fades, oldest first
+        self.fades = []
+        # timeout stepping the fades when merges are not scheduled
+        self.fadePending = None
+        # timeout retrying the skipped outputs when merges are not scheduled
+        self.outputPending = None
+        # file written by saveSnapshot, see startSnapshots
+        self.snapshotPath = None
+        # (path, content) of the last snapshot written, see saveSnapshot
+        self.lastSnapshot = None
+        # frame log of the output, see startRecording
+        self.recorder = None
 
 
     def onEvent(self, event):
-        if event[0] == "connection closed":
+        if event[0] in ("connection closed", "file descriptor unmanaged"):
+            self.handleClosedConnection(event[1])
+        elif event[0] == "connection error" and event[1] in self.outputs:
+            ## the driver is gone (EPIPE): its held fd is never released
             self.handleClosedConnection(event[1])
+        elif event[0] == "timeout":
+            self.handleTimeout(event[1])
+        elif event[0] == "packet" and isinstance(event[2], ChannelUpdates):
+            errors = self.channelUpdates(event[2])
+            if errors:
+                self.com.send(event[1], {"errors": errors})
+            return
         CommunicationManagerHandler.onEvent(self, event)
 
+    def handleRequest(self, request, cid):
+        if self.batching:
+            return CommunicationManagerHandler.handleRequest(self, request, cid)
+        start = time.time()
+        r = CommunicationManagerHandler.handleRequest(self, request, cid)
+        self.stats.dispatch.addDuration(time.time() - start)
+        try:
+            name = request["request"]
+            self.stats.requests[name] = self.stats.requests.get(name, 0) + 1
+        except (KeyError, TypeError):
+            pass
+        return r
+
+    def handleTimeout(self, payload):
+        """
+            Dispatch timeouts set by the merger. Payloads are tuples whose
+            first item is a key of timeout_type.
+        """
+        try:
+            handler = self.timeout_type[payload[0]]
+        except (KeyError, TypeError, IndexError):
+            return
+        handler(self, payload)
+
+    def mergeTimeout(self, payload):
+        self.scheduler.onTimeout()
+
+    def snapshotTimeout(self, payload):
+        ## armed first: a failing save doesn't stop the periodic snapshots
+        self.com.setTimeout(payload[1], payload)
+        try:
+            self.saveSnapshot(changedOnly=True)
+        except (IOError, OSError, struct.error), e:
+            print >>sys.stderr, "Snapshot failed: %s" % e
+
+    def outputTimeout(self, payload):
+        self.outputPending = None
+        self.updateUnivers()
+
+    def fadeTimeout(self, payload):
+        self.fadePending = None
+        self.advanceFades(time.time())
+        self.requestMerge()
+        self.nextFadeStep()
+
     def handleClosedConnection(self, cid):
-        layers_to_remove = []
-        for layer in self.layers:
-            if layer.status != "persistent" and layer.cid == cid:
-                layers_to_remove.append(layer)
+        if cid in self.outputs:
+            self.outputs.pop(cid).close()
+            return
+        self.subscriptions.pop(cid, None)
+        for fade in self.fades:
+            if fade.cid == cid:
+                fade.cid = None
 
-        map(self.delLayer, layers_to_remove)
+        layers = self.cidLayers.pop(cid, None)
+        if layers:
+            self.delLayers(layers)
+            self.requestMerge()
 
     def newLayer(self, request, cid, r):
         """
@@ -166,83 +359,518 @@ class Merger(CommunicationManagerHandler):
         l = Layer(request["layer"])
         l.status = request.get("status", "volatile") # or pesistent
         l.cid = cid
+        channels = self.parseChannels(request.get("channels", []))
         self.addLayer(l)
         r["status"] = "ok"
-        self.newChannel(request, cid, r)
+        r["lid"] = l.lid
+        self.addChannels(l, channels)
 
     def removeLayer(self, request, cid, r):
         self.delLayer(request["layer"])
         r["status"] = "ok"
+        self.requestMerge()
 
     def newChannel(self, request, cid, r):
         l = self.getLayer(request["layer"])
-        channels = request.get("channels", [])
+        self.addChannels(l, self.parseChannels(request.get("channels", [])))
+
+    def parseChannels(self, channels):
+        """
+            Check the channels of a new layer or new channels request, so
+            that a bad channel is reported before the layer changes.
+            @return: a list of (address, value, mixType, nbChan)
+        """
+        result = []
         for channel in channels:
             address = int(channel["address"])
-            try:
-                mixType = float(channel.get("mixType", 1.0))
-            except ValueError:
-                mixType = channel["mixType"]
-            nbChan = int(channel.get("nbChan", 1))
-            value = int(channel["value"]) & (256 * nbChan - 1)
+            mixType = parseMixType(channel.get("mixType", 1.0))
+            nbChan = parseNbChan(channel.get("nbChan", 1))
+            self.checkAddress(address, nbChan)
+            value = int(channel["value"]) & (256 ** nbChan - 1)
+            result.append((address, value, mixType, nbChan))
+        return result
+
+    def checkAddress(self, address, nbChan=1):
+        """
+            Reject the channels outside of the first maxUniverses universes.
+        """
+        if address < 1 or address + nbChan - 1 > self.maxUniverses * DMXGalaxy.UNIVERS_SIZE:
+            raise ValueError("Bad DMX address: %d" % address)
+
+    def addChannels(self, l, channels):
+        """
+            Add or replace channels checked by parseChannels.
+        """
+        for address, value, mixType, nbChan in channels:
+            if address in l.channels:
+                self.touch(address, l.channels[address].nbChan)
             l.addChannel(address, value, mixType, nbChan)
-        self.merge()
+            self.touch(address, nbChan, replan=True)
+        self.layerChanged(l)
+        self.requestMerge()
 
     def updateChannel(self, request, cid, r):
         l = self.getLayer(request["layer"])
-        channels = request.get("channels", [])
-        for channel in channels:
+        ## every channel is checked before the layer changes
+        channels = []
+        for channel in request.get("channels", []):
             address = int(channel["address"])
-            mixType = None if not channel.has_key("mixType") else float(channel.get("mixType", 1.0))
-            value = None if not channel.has_key("value") else int(channel["value"]) & (256 * nbChan - 1)
+            nbChan = l.channels[address].nbChan
+            mixType = None if not channel.has_key("mixType") else parseMixType(channel["mixType"])
+            value = None if not channel.has_key("value") else int(channel["value"]) & (256 ** nbChan - 1)
+            channels.append((address, nbChan, value, mixType))
+        for address, nbChan, value, mixType in channels:
             l.updateChannel(address, value, mixType)
-        self.merge()
+            self.touch(address, nbChan, replan=mixType is not None)
+        self.layerChanged(l)
+        self.requestMerge()
 
-    def removeChannel(self, request, cid, r):
+    def channelUpdates(self, updates):
+        """
+            Apply channel updates received with the binary protocol.
+            @param updates: (layer id, address, value, mixType) tuples,
+            mixType being None to keep the current one. Errors of the
+            decoding are in its errors list, if any.
+            @return: a list of errors
+        """
+        errors = list(getattr(updates, "errors", []))
+        for lid, address, value, mixType in updates:
+            try:
+                l = self.layerIds[lid]
+                nbChan = l.channels[address].nbChan
+            except KeyError:
+                errors.append("Unknow layer id or channel: %d %d" % (lid, address))
+                continue
+            if mixType is not None:
+                try:
+                    mixType = parseMixType(mixType)
+                except ValueError, e:
+                    errors.append(str(e))
+                    continue
+            l.updateChannel(address, value & (256 ** nbChan - 1), mixType)
+            self.touch(address, nbChan, replan=mixType is not None)
+            self.layerChanged(l)
+        self.requestMerge()
+        return errors
+
+    def fade(self, request, cid, r):
+        """
+            Move channels of a layer to a new value and/or mixType over a
+            duration (in seconds), on the merger frame tick.
+            {
+                "id" : "1",
+                "request": "fade",
+                "layer": "2",
+                "duration": 2.5,
+                "channels": [
+                    {"address": "1", "value": "255"},
+                    {"address": "2", "mixType": 0.0}
+                ]
+            }
+            Without "channels", the "value" and/or "mixType" of the request
+            apply to every channel of the layer: fading the mixType of a
+            layer from 0.0 to 1.0 crossfades it with the layers below.
+
+            Values and float mixTypes are interpolated, other mixTypes are
+            set at the end. A fade takes its channels from older fades.
+            When the fade ends, {"id": "1", "status": "complete"} is sent,
+            or "cancelled" if the layer has been removed or all its channels
+            have been taken by other fades.
+        """
         l = self.getLayer(request["layer"])
-        channels = request.get("channels", [])
+        duration = float(request["duration"])
+        if math.isinf(duration) or math.isnan(duration) or duration < 0:
+            raise ValueError("Bad fade duration: %s" % duration)
+        if "channels" in request:
+            channels = request["channels"]
+        else:
+            if request.has_key("mixType"):
+                parseMixType(request["mixType"])
+            channels = [dict(request, address=address) for address in l.channels]
+
+        targets = {}
         for channel in channels:
             address = int(channel["address"])
+            nbChan = l.channels[address].nbChan
+            value = None
+            if channel.has_key("value"):
+                value = int(channel["value"]) & (256 ** nbChan - 1)
+            mixType = None
+            if channel.has_key("mixType"):
+                mixType = parseMixType(channel["mixType"])
+            targets[address] = (value, mixType)
+
+        for fade in self.fades:
+            if fade.layer is l:
+                for address in targets:
+                    fade.cancel(address)
+        self.fades.append(Fade(request["id"], cid, l, targets, duration, time.time()))
+        r["status"] = "ok"
+        self.nextFadeStep()
+
+    def removeChannel(self, request, cid, r):
+        l = self.getLayer(request["layer"])
+        ## every address is checked before the layer changes
+        addresses = [int(channel["address"]) for channel in request.get("channels", [])]
+        for address in addresses:
+            if address not in l.channels:
+                raise KeyError(address)
+        for address in set(addresses):
+            self.touch(address, l.channels[address].nbChan, replan=True)
             l.delChannel(address)
-        self.merge()
+        self.layerChanged(l)
+        self.requestMerge()
 
 
     def addLayer(self, layer):
         self.delLayer(layer.level)
-        self.layers.append(layer)
+        position = bisect.bisect_right(self.layerKeys, layer.key)
+        self.layers.insert(position, layer)
+        self.layerKeys.insert(position, layer.key)
+        self.layerIndex[layer.level] = layer
+        ## a layer put back by a batch rollback keeps its lid
+        if layer.lid is None or layer.lid in self.layerIds:
+            while self.nextLid in self.layerIds:
+                self.nextLid = self.nextLid % 0xffff + 1
+            layer.lid = self.nextLid
+            self.nextLid = self.nextLid % 0xffff + 1
+        self.layerIds[layer.lid] = layer
+        if layer.status != "persistent" and layer.cid is not None:
+            self.cidLayers.setdefault(layer.cid, set()).add(layer)
+        self.touchLayer(layer)
 
     def getLayer(self, level):
-        for layer in self.layers:
-            if layer.level == level:
-                return layer
-        raise ValueError("Unknow layer: %s" % level)
-            
+        try:
+            return self.layerIndex[level]
+        except KeyError:
+            raise ValueError("Unknow layer: %s" % level)
 
     def delLayer(self, layer):
         if type(layer) not in (type(""), type(u"")):
             layer = layer.level
-        for layer_l in self.layers:
-            if layer == layer_l.level:
-                self.layers.remove(layer_l)
+        layer = self.layerIndex.pop(layer, None)
+        if layer is None:
+            return
+        position = bisect.bisect_left(self.layerKeys, layer.key)
+        while self.layers[position] is not layer:
+            position += 1
+        del self.layers[position]
+        del self.layerKeys[position]
+        self.forgetLayer(layer)
+
+    def delLayers(self, layers):
+        """
+            Remove several layers with one pass over the layer list.
+            @param layers: a set of Layer instances managed by the merger
+        """
+        self.layers = [layer for layer in self.layers if layer not in layers]
+        self.layerKeys = [layer.key for layer in self.layers]
+        for layer in layers:
+            del self.layerIndex[layer.level]
+            self.forgetLayer(layer)
+
+    def forgetLayer(self, layer):
+        """
+            Drop the indexes of a layer removed from self.layers.
+        """
+        del self.layerIds[layer.lid]
+        owned = self.cidLayers.get(layer.cid)
+        if owned is not None:
+            owned.discard(layer)
+            if not owned:
+                del self.cidLayers[layer.cid]
+        self.touchLayer(layer)
+
+    def touch(self, address, nbChan=1, replan=False):
+        """
+            Mark DMX addresses as needing a recompute at the next mergeDirty.
+            @param address: the first address of the channel
+            @param nbChan: how many DMX channels the channel spans
+            @param replan: True if a channel starting at address has been
+            added, removed or has a new mixType: its mix plan is rebuilt
+        """
+        self.dirty.update(range(address, address + nbChan))
+        if nbChan > self.maxNbChan:
+            self.maxNbChan = nbChan
+        if replan:
+            self.plans.pop(address, None)
+
+    def touchLayer(self, layer):
+        for address, channel in layer.channels.items():
+            self.touch(address, channel.nbChan, replan=True)
+        self.layerChanged(layer)
+
+    def layerChanged(self, layer):
+        """
+            Note a change of layer (channels, or the layer itself added or
+            removed). The prefix is dropped if it contains the layer.
+        """
+        layer.changedAt = time.time()
+        if self.prefix is not None and layer.key < self.prefixKey:
+            self.prefix = None
+            self.prefixKey = None
+
+    def updatePrefix(self, now):
+        """
+            Rebuild the prefix if more layers became static. Layers are only
+            scanned every prefixDelay / 2 seconds.
+        """
+        if now < self.prefixCheck:
+            return
+        self.prefixCheck = now + self.prefixDelay / 2
+        recent = now - self.prefixDelay
+        static = []
+        boundary = TOP_KEY
+        for layer in self.layers:
+            if layer.changedAt > recent:
+                boundary = layer.key
                 break
+            static.append(layer)
+        if not static:
+            return
+        if self.prefix is not None and boundary == self.prefixKey:
+            return
+        ## the prefix is dropped when a layer under it changes, so a new
+        ## boundary is always above the current one
+        prefix = DMXGalaxy()
+        self.composite(static, prefix)
+        self.prefix = prefix
+        self.prefixKey = boundary
+
+    def composite(self, layers, galaxy):
+        """
+            Clear galaxy and merge layers (sorted from the lowest one) into it.
+        """
+        if self.engine is not None:
+            self.engine.composite(layers, galaxy)
+            return
+        galaxy.clear()
+        for layer in layers:
+            for address, channel in layer.channels.items():
+                self.merge_channel(address, channel, galaxy)
+
+    def requestMerge(self):
+        """
+            Merge the dirty addresses, now or at the next frame if merges
+            are scheduled.
+        """
+        if self.batching:
+            return
+        if self.scheduler is None:
+            self.mergeDirty()
+        else:
+            self.scheduler.request()
+
+    def frame(self):
+        """
+            Called by the scheduler once per frame.
+        """
+        if self.fades:
+            self.advanceFades(time.time())
+        if self.dirty:
+            self.mergeDirty()
+        else:
+            ## retry outputs skipped by slow drivers
+            self.updateUnivers()
+        self.nextFadeStep()
+
+    def nextFadeStep(self):
+        """
+            Ask for the next frame tick while fades are running.
+        """
+        if not self.fades:
+            return
+        if self.scheduler is not None:
+            self.scheduler.retry()
+        elif self.fadePending is None and getattr(self, "com", None) is not None:
+            self.fadePending = self.com.setTimeout(1.0 / FRAME_RATE, ("fade",))
+
+    def advanceFades(self, now):
+        """
+            Apply the state of the running fades at now, and notify the
+            fades that ended. The changed addresses are only marked dirty.
+        """
+        ended = []
+        for fade in self.fades:
+            layer = fade.layer
+            if self.layerIndex.get(layer.level) is not layer or not fade.channels:
+                ended.append((fade, "cancelled"))
+                continue
+            changed = False
+            for address, value, mixType in fade.step(now):
+                channel = layer.channels.get(address)
+                if channel is None:
+                    continue
+                if value == channel.value:
+                    value = None
+                if mixType == channel.mixType:
+                    mixType = None
+                if value is None and mixType is None:
+                    continue
+                layer.updateChannel(address, value, mixType)
+                self.touch(address, channel.nbChan, replan=mixType is not None)
+                changed = True
+            if changed:
+                self.layerChanged(layer)
+            if fade.done:
+                ended.append((fade, "complete"))
+
+        for fade, status in ended:
+            self.fades.remove(fade)
+            if fade.cid is not None:
+                self.com.send(fade.cid, {"id": fade.rid, "status": status})
 
     def merge(self):
-        self.galaxy.clear()
-        self.layers.sort()
+        """
+            Recompute the whole galaxy from every layer.
+        """
+        start = time.time()
+        self.dirty = set()
+        ## layers may have been changed directly, forget everything
+        self.plans = {}
+        self.prefix = None
+        self.prefixKey = None
+
+        self.composite(self.layers, self.galaxy)
 
+        self.merged(start, sum([len(layer.channels) for layer in self.layers]))
+
+    def plan(self, address):
+        """
+            Get the mix plan of the channels starting at address, compiled
+            if needed. Plans only change when a channel starting at address
+            is added or removed, or gets a new mixType (see touch).
+
+            @return: (span, entries, keys) where span is the widest nbChan
+            of the channels, entries are (layer key, channel, mode, factor)
+            tuples, from the lowest layer, and keys are the layer keys of
+            the entries, for bisection
+        """
+        try:
+            return self.plans[address]
+        except KeyError:
+            pass
+        entries = []
+        span = 0
         for layer in self.layers:
-            for item in layer.channels.items():
-                self.merge_channel(*item)
+            channel = layer.channels.get(address)
+            if channel is None:
+                continue
+            mixType = channel.mixType
+            if type(mixType) == type(1.0):
+                entries.append((layer.key, channel, MIX, mixType))
+            elif mixType in mixModes:
+                entries.append((layer.key, channel, mixModes[mixType], None))
+            else:
+                raise ValueError("%s: Unknow mix type" % mixType)
+            span = max(span, channel.nbChan)
+        keys = [entry[0] for entry in entries]
+        plan = self.plans[address] = (span, entries, keys)
+        return plan
+
+    def mergeDirty(self):
+        """
+            Recompute only the addresses touched since the last merge, using
+            the mix plans of these addresses, from the prefix values.
 
+            A channel covering a dirty address is replayed as a whole, so
+            every address it spans is recomputed too. The dirty set is grown
+            until it is closed under this rule.
+        """
+        if not self.dirty:
+            return
+        start = time.time()
+        self.updatePrefix(start)
+        addresses = self.dirty
+        self.dirty = set()
+
+        starts = set()
+        # addresses spanned by channels wider than 8 bits
+        wide = set()
+        pending = list(addresses)
+        while pending:
+            address = pending.pop()
+            for first in range(address - self.maxNbChan + 1, address + 1):
+                span, entries, keys = self.plan(first)
+                if first + span <= address:
+                    continue
+                starts.add(first)
+                if span > 1:
+                    for covered in range(first, first + span):
+                        wide.add(covered)
+                        if covered not in addresses:
+                            addresses.add(covered)
+                            pending.append(covered)
+
+        galaxy = self.galaxy
+        prefix = self.prefix
+        if prefix is None:
+            for address in addresses:
+                galaxy[address] = 0
+        else:
+            for address in addresses:
+                galaxy[address] = prefix[address]
+
+        mixed = 0
+        replayed = []
+        for first in starts:
+            span, entries, keys = self.plans[first]
+            if prefix is not None:
+                ## the entries below the prefix key are already in the prefix
+                entries = entries[bisect.bisect_left(keys, self.prefixKey):]
+            mixed += len(entries)
+            if first in wide:
+                replayed.extend([(key, first, channel) for key, channel, mode, factor in entries])
+                continue
+            ## 8 bits channels only: mix in a local
+            univers, offset = galaxy.locate(first)
+            value = univers[offset]
+            for key, channel, mode, factor in entries:
+                if mode == MIX:
+                    value = int((1 - factor) * value + factor * channel.value + 0.5) & 255
+                elif mode == MIN:
+                    value = min(value, channel.value) & 255
+                else:
+                    value = max(value, channel.value) & 255
+            univers[offset] = value
+
+        ## channels overlapping wider ones are replayed on the galaxy, in
+        ## layer order
+        replayed.sort(key=lambda entry: entry[0])
+        for key, first, channel in replayed:
+            self.merge_channel(first, channel)
+
+        self.merged(start, mixed, addresses)
+
+    def merged(self, start, mixed, addresses=None):
+        """
+            Scale the merged addresses by the masters, record the statistics
+            of a merge and send its result.
+            @param start: when the merge started
+            @param mixed: how many channels have been mixed
+            @param addresses: the merged addresses, None for every address
+        """
+        if self.masters.active():
+            self.masters.scale(self.galaxy, self.scaled, addresses)
+        now = time.time()
+        self.stats.merge.addDuration(now - start)
+        self.stats.mixed.add(mixed)
         self.updateUnivers()
+        self.stats.output.addDuration(time.time() - now)
 
-    def merge_channel(self, address, channel):
+    def merge_channel(self, address, channel, galaxy=None):
+        if galaxy is None:
+            galaxy = self.galaxy
+        if channel.nbChan == 1:
+            univers, offset = galaxy.locate(address)
+            univers[offset] = self.mix_channel(univers[offset], channel) & 255
+            return
         old_value = 0
         for i in range(channel.nbChan):
-            old_value = (old_value << 8) + self.galaxy[address + i]
+            old_value = (old_value << 8) + galaxy[address + i]
         value = self.mix_channel(old_value, channel)
         for i in range(channel.nbChan):
-            self.galaxy[address + (channel.nbChan - i - 1)] = value & 255
+            galaxy[address + (channel.nbChan - i - 1)] = value & 255
             value >>= 8
 
     def mix_channel(self, value, channel):
@@ -256,8 +884,185 @@ class Merger(CommunicationManagerHandler):
         raise ValueError("%s: Unknow mix type" % channel.mixType)
 
 
+    def outputGalaxy(self):
+        """
+            @return: the galaxy sent to the outputs, scaled by the masters
+        """
+        if self.masters.active():
+            return self.scaled
+        return self.galaxy
+
     def updateUnivers(self):
-        pass
+        """
+            Called after each merge. Send the changed universes to the drivers.
+        """
+        galaxy = self.outputGalaxy()
+        if self.sharedGalaxy is not None:
+            self.sharedGalaxy.publish(galaxy)
+        retry = None
+        for output in self.outputs.values():
+            if output.update(galaxy.univers(output.univers)):
+                retry = 1.0 / FRAME_RATE
+        if self.subscriptions:
+            delay = self.publishOutput()
+            if delay is not None and (retry is None or delay < retry):
+                retry = delay
+        if retry is not None:
+            self.retryOutput(retry)
+        if self.recorder is not None:
+            self.recorder.record(galaxy.universes)
+
+    def retryOutput(self, delay):
+        """
+            Ask for another output update, for the outputs skipped by a slow
+            driver. Without a scheduler, a timeout is armed in delay seconds.
+        """
+        if self.scheduler is not None:
+            self.scheduler.retry()
+        elif self.outputPending is None and getattr(self, "com", None) is not None:
+            self.outputPending = self.com.setTimeout(delay, ("output",))
+
+    def publishOutput(self):
+        """
+            Send the output changes to the subscribed connections.
+            @return: the delay (in seconds) until a subscriber skipped by its
+            rate limit can be sent its changes, None if none was skipped
+        """
+        now = time.time()
+        frames = [str(univers) for univers in self.outputGalaxy().universes]
+        retry = None
+        for cid, subscription in self.subscriptions.items():
+            if subscription.frames == frames:
+                continue
+            delay = subscription.lastSent + subscription.period - now
+            if delay > 0:
+                if retry is None or delay < retry:
+                    retry = delay
+                continue
+            subscription.lastSent = now
+            self.com.send(cid, {"id": subscription.rid, "changes": subscription.changes(frames)})
+        return retry
+
+    def attachDriver(self, univers, fd, process=None):
+        """
+            Send the frames of an univers to a driver reading on fd.
+            @return: the DriverOutput
+        """
+        output = DriverOutput(self.com, univers, fd, process)
+        self.outputs[fd] = output
+        self.updateUnivers()
+        return output
+
+    def exportGalaxy(self, path, universes):
+        """
+            Publish the galaxy in a memory mapped file after each merge (see
+            sharedgalaxy).
+        """
+        self.sharedGalaxy = SharedGalaxy(path, universes)
+        self.sharedGalaxy.publish(self.outputGalaxy())
+
+    def startRecording(self, path, keyframeInterval=1.0):
+        """
+            Record the output in a frame log (see framelog).
+        """
+        self.stopRecording()
+        self.recorder = Recorder(path, keyframeInterval)
+        self.recorder.record(self.outputGalaxy().universes)
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def startSnapshots(self, path, period=None):
+        """
+            Save snapshots to path, on "snapshot" requests, when quitting,
+            and every period seconds if period is given.
+        """
+        self.snapshotPath = path
+        if period:
+            self.com.setTimeout(period, ("snapshot", period))
+
+    def takeSnapshot(self):
+        """
+            @return: a Snapshot of the persistent layers, the masters and
+            the merged galaxy
+        """
+        layers = []
+        for layer in self.layers:
+            if layer.status != "persistent":
+                continue
+            channels = [(address, channel.value, channel.mixType, channel.nbChan)
+                for address, channel in layer.channels.items()]
+            layers.append((layer.level, channels))
+        masters = [(master.name, master.level, master.channels) for master in self.masters.groups.values()]
+        return Snapshot(layers, masters, self.masters.grand, self.galaxy.universes)
+
+    def saveSnapshot(self, path=None, changedOnly=False):
+        """
+            Write a snapshot to path, or to the path given to startSnapshots.
+            @param changedOnly: skip the write (and its fsync) if nothing
+            changed since the last snapshot written to path
+            @return: True if the snapshot has been written
+        """
+        path = path or self.snapshotPath
+        if path is None:
+            raise ValueError("No snapshot file")
+        snapshot = self.takeSnapshot()
+        ## the content without the time, to compare snapshots
+        when, snapshot.time = snapshot.time, 0
+        content = snapshot.pack()
+        if changedOnly and self.lastSnapshot == (path, content):
+            return False
+        snapshot.time = when
+        snapshot.write(path)
+        self.lastSnapshot = (path, content)
+        return True
+
+    def restore(self, path):
+        """
+            Restore the persistent layers, the masters and the output of a
+            snapshot.
+
+            The output is the one of the snapshot, which may include volatile
+            layers: the addresses where it differs from the restored layers
+            are marked dirty, and are fixed by the next merge.
+        """
+        snapshot = Snapshot.read(path)
+        for level, channels in snapshot.layers:
+            l = Layer(level)
+            l.status = "persistent"
+            l.cid = None
+            for address, value, mixType, nbChan in channels:
+                self.checkAddress(address, nbChan)
+                l.addChannel(address, value, mixType, nbChan)
+            self.addLayer(l)
+        for name, level, channels in snapshot.masters:
+            self.masters.define(name, channels, level)
+        self.masters.setGrand(snapshot.grand)
+
+        self.dirty = set()
+        self.composite(self.layers, self.galaxy)
+        for index, frame in enumerate(snapshot.universes):
+            univers = self.galaxy.univers(index)
+            base = index * DMXGalaxy.UNIVERS_SIZE
+            for offset in xrange(1, len(frame)):
+                if univers[offset] != frame[offset]:
+                    self.dirty.add(base + offset)
+            univers[:] = frame
+        self.rescale()
+
+    def spawnDriver(self, univers, args):
+        """
+            Start a driver process reading the frames of an univers on its
+            stdin.
+            @param args: the driver command line, as a list
+            @return: the DriverOutput
+        """
+        output = spawnDriver(self.com, univers, args)
+        self.outputs[output.fd] = output
+        self.updateUnivers()
+        return output
 
     def status(self, request, cid, r):
         layers = {}
@@ -270,14 +1075,261 @@ class Merger(CommunicationManagerHandler):
                     "nbChan": channel.nbChan,
                 }
             layers[layer.level] = l
-        r["data"] = {"layers" : layers}
+        masters = dict((name, master.level) for name, master in self.masters.groups.items())
+        r["data"] = {"layers" : layers, "masters": masters, "grand master": self.masters.grand}
 
     def output(self, request, cid, r):
-        r["output"] = self.galaxy
+        """
+            The merged DMX values, scaled by the masters, one list of 512
+            values per univers.
+        """
+        r["output"] = self.outputGalaxy().toList()
+
+    def newMaster(self, request, cid, r):
+        """
+            Create or replace a master group, scaling the output of its
+            channels by its level (between 0.0 and 1.0).
+            {
+                "id" : "1",
+                "request": "new master",
+                "master": "front",
+                "level": 1.0,
+                "channels": [
+                    {"address": "1"},
+                    {"address": "10", "nbChan": "2"}
+                ]
+            }
+        """
+        channels = {}
+        for channel in request.get("channels", []):
+            address = int(channel["address"])
+            channels[address] = parseNbChan(channel.get("nbChan", 1))
+            self.checkAddress(address, channels[address])
+        self.masters.define(request["master"], channels, float(request.get("level", 1.0)))
+        self.rescale()
+        r["status"] = "ok"
+
+    def removeMaster(self, request, cid, r):
+        self.rescale(self.masters.remove(request["master"]))
+        r["status"] = "ok"
+
+    def masterLevel(self, request, cid, r):
+        """
+            Change the level of a master group. Only its channels are
+            rescaled.
+            {
+                "id" : "1",
+                "request": "master level",
+                "master": "front",
+                "level": 0.5
+            }
+        """
+        self.rescale(self.masters.setLevel(request["master"], float(request["level"])))
+        r["status"] = "ok"
+
+    def grandMaster(self, request, cid, r):
+        """
+            Change the level of the grand master, scaling every channel.
+            {
+                "id" : "1",
+                "request": "grand master",
+                "level": 0.8
+            }
+        """
+        self.masters.setGrand(float(request["level"]))
+        self.rescale()
+        r["status"] = "ok"
+
+    def rescale(self, addresses=None):
+        """
+            Scale the merged galaxy after a master change, and send the
+            result at the next frame.
+            @param addresses: the addresses whose factor changed, None for
+            every address
+        """
+        if self.masters.active():
+            self.masters.scale(self.galaxy, self.scaled, addresses)
+        if self.scheduler is None:
+            self.updateUnivers()
+        else:
+            self.scheduler.retry()
+
+
+    def subscribeOutput(self, request, cid, r):
+        """
+            Push the output changes to this connection instead of polling
+            the output request.
+            {
+                "id" : "1",
+                "request": "subscribe output",
+                "rate": 30
+            }
+            The output is considered all 0 at the subscription. Then a message
+            is sent each time the output changes, at most "rate" times per
+            second (default: 30), with the changed address ranges:
+            {"id": "1", "changes": [[1, [255, 0, 127]], [514, [12]]]}
+        """
+        self.subscriptions[cid] = OutputSubscription(request["id"], float(request.get("rate", 30)))
+        r["status"] = "ok"
+        if self.scheduler is not None:
+            self.scheduler.retry()
+        else:
+            self.updateUnivers()
+
+    def unsubscribeOutput(self, request, cid, r):
+        self.subscriptions.pop(cid, None)
+        r["status"] = "ok"
+
+    def batch(self, request, cid, r):
+        """
+            Apply several layer and channel requests in order, and merge once
+            at the end, so that no intermediate state reaches the output.
+            {
+                "id" : "1",
+                "request": "batch",
+                "operations": [
+                    {"request": "update channels", "layer": "1", "channels": [...]},
+                    {"request": "remove layer", "layer": "2"}
+                ]
+            }
+            "results" holds one result per operation, in the same order, with
+            a "status" or an "error" key.
+
+            The batch is atomic: the first failing operation stops it, the
+            changes of the previous operations are rolled back and the answer
+            has an "error" key. "results" then ends with the failed operation.
+        """
+        results = []
+        ## level -> (layer, channels) before the batch, see saveLayer
+        journal = {}
+        fades = None
+        self.batching = True
+        try:
+            for index, operation in enumerate(request["operations"]):
+                if not isinstance(operation, dict):
+                    result = {"error": "Malformed operation: %r" % (operation,)}
+                elif operation.get("request") not in self.batch_types:
+                    result = {"error": "Not allowed in a batch: %s" % operation.get("request")}
+                else:
+                    level = operation.get("layer")
+                    if type(level) in (type(""), type(u"")):
+                        self.saveLayer(journal, level)
+                    if operation["request"] == "fade" and fades is None:
+                        fades = [(fade, dict(fade.channels)) for fade in self.fades]
+                    operation = dict(operation)
+                    operation["id"] = index
+                    result = self.handleRequest(operation, cid)
+                    del result["id"]
+                    if not result.has_key("error"):
+                        result.setdefault("status", "ok")
+                results.append(result)
+                if result.has_key("error"):
+                    self.restoreLayers(journal)
+                    if fades is not None:
+                        self.fades = [fade for fade, channels in fades]
+                        for fade, channels in fades:
+                            fade.channels = channels
+                    r["error"] = "Batch rejected, operation %d failed: %s" % (index, result["error"])
+                    break
+            else:
+                r["status"] = "ok"
+            r["results"] = results
+        finally:
+            self.batching = False
+            self.requestMerge()
 
+    def saveLayer(self, journal, level):
+        """
+            Record the layer of a level and a copy of its channels, before
+            the first batch operation on this level.
+        """
+        if level in journal:
+            return
+        layer = self.layerIndex.get(level)
+        channels = None
+        if layer is not None:
+            channels = dict((address, Channel(channel.value, channel.mixType, channel.nbChan))
+                for address, channel in layer.channels.items())
+        journal[level] = (layer, channels)
+
+    def restoreLayers(self, journal):
+        """
+            Put back the layers recorded by saveLayer: layers created since
+            are removed, removed ones are added back with their lid.
+        """
+        for level, (layer, channels) in journal.items():
+            current = self.layerIndex.get(level)
+            if current is not None and current is not layer:
+                self.delLayer(current)
+            if layer is None:
+                continue
+            ## the addresses of the changed channels are dirty too
+            self.touchLayer(layer)
+            layer.channels = channels
+            layer.revision += 1
+            if current is layer:
+                self.touchLayer(layer)
+            else:
+                self.addLayer(layer)
+
+    def statsRequest(self, request, cid, r):
+        """
+            Report the merger statistics: request dispatch, merge and output
+            times (in us), channels mixed per merge, request counts, and the
+            bytes read and written by the communication manager.
+            {
+                "id" : "1",
+                "request": "stats",
+                "reset": true
+            }
+            "reset" (optional) clears the statistics after the report.
+        """
+        data = self.stats.toDict()
+        com = getattr(self, "com", None)
+        if com is not None:
+            data["bytes in"] = getattr(com, "bytesIn", 0)
+            data["bytes out"] = getattr(com, "bytesOut", 0)
+        if self.scheduler is not None:
+            data["scheduler"] = self.scheduler.stats()
+        r["data"] = data
+        if request.get("reset", False):
+            self.stats.reset()
+
+    def schedulerStatus(self, request, cid, r):
+        """
+            Report merge scheduling statistics. A "rate" key (in Hz) changes
+            the merge rate.
+            {
+                "id" : "1",
+                "request": "scheduler",
+                "rate": 44
+            }
+        """
+        if self.scheduler is None:
+            raise ValueError("Merges are not scheduled")
+        if request.has_key("rate"):
+            self.scheduler.setRate(float(request["rate"]))
+        r["data"] = self.scheduler.stats()
+
+    def snapshotRequest(self, request, cid, r):
+        """
+            Save a snapshot now, to the file given with --snapshot.
+            {
+                "id" : "1",
+                "request": "snapshot"
+            }
+        """
+        self.saveSnapshot()
+        r["status"] = "ok"
 
     def quit(self, request, cid, r):
-        self.com.stop()
+        ## a failing save is reported, but doesn't keep the merger running
+        try:
+            if self.snapshotPath is not None:
+                self.saveSnapshot()
+        finally:
+            self.stopRecording()
+            self.com.stop()
         r["status"] = "ok"
 
     request_type = {
@@ -287,23 +1339,225 @@ class Merger(CommunicationManagerHandler):
         "new channels": newChannel,
         "remove channels": removeChannel,
         "update channels": updateChannel,
+        "fade": fade,
+
+        "batch": batch,
+
+        "new master": newMaster,
+        "remove master": removeMaster,
+        "master level": masterLevel,
+        "grand master": grandMaster,
 
         "status": status,
         "output": output,
+        "subscribe output": subscribeOutput,
+        "unsubscribe output": unsubscribeOutput,
+        "scheduler": schedulerStatus,
+        "stats": statsRequest,
+        "snapshot": snapshotRequest,
         "quit": quit
     }
 
+    batch_types = set([
+        "new layer",
+        "remove layer",
+        "new channels",
+        "remove channels",
+        "update channels",
+        "fade",
+    ])
+
+    timeout_type = {
+        "merge": mergeTimeout,
+        "fade": fadeTimeout,
+        "output": outputTimeout,
+        "snapshot": snapshotTimeout,
+    }
+
+
+class MergeScheduler(object):
+    """
+        Coalesce merge requests so that at most one merge runs per output
+        frame.
+
+        A merge request arms a timeout of the communication manager at the
+        next frame boundary, unless one is already pending. Requests received
+        in between only add dirty addresses to the next merge.
+    """
+    def __init__(self, com, merge, rate):
+        """
+            @param com: the communication manager providing timeouts
+            @param merge: the callable doing the merge
+            @param rate: the maximum merge rate, in Hz
+        """
+        self.com = com
+        self.merge = merge
+        self.pending = None
+        self.lastMerge = 0
+        self.setRate(rate)
+
+    def setRate(self, rate):
+        """
+            Change the merge rate. Statistics are reset.
+        """
+        if rate <= 0:
+            raise ValueError("Bad merge rate: %s" % rate)
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.requests = 0
+        self.merges = 0
+        self.since = time.time()
+
+    def request(self):
+        self.requests += 1
+        self.retry()
+
+    def retry(self):
+        """
+            Ask for a frame without counting a merge request.
+        """
+        if self.pending is None:
+            delay = max(0.0, self.lastMerge + self.period - time.time())
+            self.pending = self.com.setTimeout(delay, ("merge",))
+
+    def onTimeout(self):
+        self.pending = None
+        self.lastMerge = time.time()
+        self.merges += 1
+        self.merge()
+
+    def stats(self):
+        """
+            @return: the configured rate, the actual merge rate (merges per
+            second since the last rate change) and the coalescing ratio
+            (merge requests per merge)
+        """
+        elapsed = time.time() - self.since
+        return {
+            "rate": self.rate,
+            "merge rate": self.merges / elapsed if elapsed > 0 else 0.0,
+            "coalescing": float(self.requests) / self.merges if self.merges else 0.0,
+            "requests": self.requests,
+            "merges": self.merges,
+        }
+
+
+class DMXGalaxy(object):
+    """
+        The DMX galaxy is the set of all the DMX univers driven by the merger.
+
+        Each univers is a 513 bytes bytearray: the DMX start code (always 0)
+        followed by the 512 channel values, so it can be written as is to a
+        driver. Addresses are global and begin at 1: address 513 is the first
+        channel of the second univers.
+
+        Universes are created when an address inside them is written.
+    """
+
+    UNIVERS_SIZE = 512
+    EMPTY_UNIVERS = bytearray(UNIVERS_SIZE + 1)
 
-class DMXGalaxy(defaultdict):
     def __init__(self):
-        defaultdict.__init__(self, lambda:0)
+        self.universes = []
+
+    def univers(self, index):
+        """
+            @return: the buffer of the univers index, created if needed
+        """
+        while len(self.universes) <= index:
+            self.universes.append(bytearray(self.EMPTY_UNIVERS))
+        return self.universes[index]
+
+    def locate(self, address):
+        """
+            @return: (univers buffer, offset in this buffer) of an address
+        """
+        if address < 1:
+            raise ValueError("Bad DMX address: %d" % address)
+        index, offset = divmod(address - 1, self.UNIVERS_SIZE)
+        return self.univers(index), offset + 1
+
+    def __getitem__(self, address):
+        if address < 1:
+            raise ValueError("Bad DMX address: %d" % address)
+        index, offset = divmod(address - 1, self.UNIVERS_SIZE)
+        if index >= len(self.universes):
+            return 0
+        return self.universes[index][offset + 1]
+
+    def __setitem__(self, address, value):
+        univers, offset = self.locate(address)
+        univers[offset] = value
+
+    def clear(self):
+        """
+            Set every channel to 0. Universes are kept.
+        """
+        for univers in self.universes:
+            univers[:] = self.EMPTY_UNIVERS
+
+    def toList(self):
+        """
+            @return: the channel values (start codes excluded), one list per
+            univers
+        """
+        return [list(univers[1:]) for univers in self.universes]
+
+
+FRAME_RATE = 44
 
 
 def main():
     """Create a default communication manager listening on a unix socket"""
-    com = CommunicationManager()
-    merger = Merger(com)
-    com.listenUnix("/tmp/llmerger", protoIn, protoOut)
+    parser = optparse.OptionParser()
+    parser.add_option("-r", "--rate", type="float", default=FRAME_RATE,
+        help="maximum merge rate, in Hz (default: %default)")
+    parser.add_option("-d", "--driver", action="append", default=[], metavar="UNIVERS:COMMAND",
+        help="start a driver process reading the univers frames on its stdin, "
+        "e.g. \"0:../drivers/enttec_open_usb_dmx any\" (can be repeated)")
+    parser.add_option("-s", "--shared-galaxy", metavar="PATH",
+        help="publish the galaxy in a memory mapped file, e.g. /dev/shm/llgalaxy")
+    parser.add_option("-u", "--shared-universes", type="int", default=16,
+        help="univers count published in the shared file (default: %default)")
+    parser.add_option("-S", "--snapshot", metavar="PATH",
+        help="restore the persistent layers from this file at startup, "
+        "and save them to it periodically and when quitting")
+    parser.add_option("-p", "--snapshot-period", type="float", default=10,
+        help="seconds between two snapshots (default: %default)")
+    parser.add_option("-n", "--max-universes", type="int", default=MAX_UNIVERSES,
+        help="univers count, higher addresses are rejected (default: %default)")
+    parser.add_option("-R", "--record", metavar="PATH",
+        help="record the output frames in a frame log (see framelogtool.py)")
+    parser.add_option("-a", "--asyncio", action="store_true", default=False,
+        help="run on an asyncio event loop (trollius on Python 2, uvloop if installed)")
+    options, args = parser.parse_args()
+
+    try:
+        from numpyengine import NumpyEngine
+        engine = NumpyEngine()
+    except ImportError:
+        engine = None
+    if options.asyncio:
+        from common.asynciocommunicationmanager import AsyncioCommunicationManager
+        com = AsyncioCommunicationManager()
+    else:
+        com = CommunicationManager()
+    merger = Merger(com, engine, options.rate, options.max_universes)
+    if options.shared_galaxy:
+        merger.exportGalaxy(options.shared_galaxy, options.shared_universes)
+    for driver in options.driver:
+        univers, command = driver.split(":", 1)
+        merger.spawnDriver(int(univers), shlex.split(command))
+    if options.snapshot:
+        if os.path.exists(options.snapshot):
+            try:
+                merger.restore(options.snapshot)
+            except (ValueError, struct.error), e:
+                print "%s: cannot restore, %s" % (options.snapshot, e)
+        merger.startSnapshots(options.snapshot, options.snapshot_period)
+    if options.record:
+        merger.startRecording(options.record)
+    com.listenUnix("/tmp/llmerger", negotiate, protoOut)
     print "ready"
     com.main()
 
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    Output of the merged universes to driver processes.
+
+    Drivers (see the drivers directory) read raw DMX frames on their stdin:
+    the start code followed by the 512 channel values, which is exactly the
+    content of a DMXGalaxy univers buffer.
+"""
+
+import os
+import fcntl
+import subprocess
+
+
+class DriverOutput(object):
+    """
+        Stream the frames of one univers to a driver through a non blocking
+        fd managed by the communication manager.
+
+        A frame is queued only if the univers changed since the last queued
+        frame, and only once the previous frame has been completely written:
+        a slow driver skips frames instead of accumulating latency.
+    """
+    def __init__(self, com, univers, fd, process=None):
+        """
+            @param com: the communication manager
+            @param univers: index of the univers to send
+            @param fd: the fd the driver reads frames from
+            @param process: the driver process (a subprocess.Popen instance)
+            if it has been spawned by the merger
+        """
+        self.com = com
+        self.univers = univers
+        self.fd = fd
+        self.process = process
+        self.lastFrame = None
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        com.addFDescriptor(fd, hold=True)
+
+    def update(self, univers):
+        """
+            Queue the univers buffer if it changed.
+            @return: True if a changed frame could not be queued because the
+            driver is still reading the previous one
+        """
+        frame = str(univers)
+        if frame == self.lastFrame:
+            return False
+        if self.com.outDataLen(self.fd) != 0:
+            return True
+        self.com.sendRaw(self.fd, frame)
+        self.lastFrame = frame
+        return False
+
+    def close(self):
+        """
+            Stop managing the driver fd. A spawned driver gets EOF and stops.
+        """
+        try:
+            self.com.removeFDescriptor(self.fd)
+        except ValueError:
+            ## already unmanaged by the communication manager
+            pass
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+def spawnDriver(com, univers, args):
+    """
+        Start a driver process and stream univers frames to its stdin.
+        @param args: the driver command line, as a list
+        @return: a DriverOutput
+    """
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, close_fds=True)
+    return DriverOutput(com, univers, process.stdin.fileno(), process)
+
+
+class OutputSubscription(object):
+    """
+        Output changes pushed to a client (see the "subscribe output"
+        request). The subscription remembers the last frames sent to the
+        client and only sends the changed address ranges.
+    """
+
+    ## changed ranges closer than this are sent as one range
+    GAP = 8
+
+    def __init__(self, rid, rate):
+        """
+            @param rid: the id of the subscribe request, used in messages
+            @param rate: the maximum message rate, in Hz
+        """
+        if rate <= 0:
+            raise ValueError("Bad rate: %s" % rate)
+        self.rid = rid
+        self.period = 1.0 / rate
+        self.lastSent = 0
+        ## the client starts with an empty (all 0) output
+        self.frames = []
+
+    def changes(self, frames):
+        """
+            Compute the changes since the last sent frames and remember frames
+            as sent.
+            @param frames: the universes, as strings
+            @return: a list of [first address, [values]]
+        """
+        changes = []
+        empty = "\0" * len(frames[0]) if frames else ""
+        for index, frame in enumerate(frames):
+            try:
+                old = self.frames[index]
+            except IndexError:
+                old = empty
+            if old == frame:
+                continue
+            base = index * (len(frame) - 1)
+            start = end = None
+            for offset in xrange(1, len(frame)):
+                if frame[offset] == old[offset]:
+                    continue
+                if start is not None and offset - end > self.GAP:
+                    changes.append([base + start, [ord(c) for c in frame[start:end + 1]]])
+                    start = None
+                if start is None:
+                    start = offset
+                end = offset
+            changes.append([base + start, [ord(c) for c in frame[start:end + 1]]])
+        self.frames = frames
+        return changes
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Play a frame log (see framelog) into the merger as a layer, on the
+    timeline of the recording.
+
+    The player creates a layer holding every channel of the recorded
+    universes, then streams the changed channels of each frame on a binary
+    protocol connection at the time they were recorded. The log is read
+    through a memory map, from a keyframe, so long recordings are neither
+    loaded in memory nor read from their start.
+
+    Usage:
+        python player.py show.fl -l 50 -s 120 --loop
+"""
+
+import sys, os
+sys.path.append(os.path.join(".."))
+
+import time
+import optparse
+
+from common.communicationmanager import CommunicationManager
+from common.communicationmanagerhandler import CommunicationManagerHandler
+from common.jsonprotocol import protoIn, protoOut
+from common.binaryprotocol import MAGIC, pack
+
+from framelog import FrameLogReader, FRAME_SIZE
+
+MERGER_SOCKET = "/tmp/llmerger"
+
+
+class Player(CommunicationManagerHandler):
+    """
+        Stream a frame log into a merger layer.
+    """
+    def __init__(self, com, reader, level, mixType=1.0, start=0.0, loop=False, path=MERGER_SOCKET):
+        """
+            @param reader: a FrameLogReader
+            @param level: the level of the played layer
+            @param mixType: the mixType of the layer channels
+            @param start: where to start, in seconds from the start of the
+            recording
+            @param loop: restart from the beginning at the end of the log
+            @param path: the merger socket
+        """
+        CommunicationManagerHandler.__init__(self, com)
+        self.reader = reader
+        keyframes = reader.index()
+        if not keyframes:
+            raise ValueError("Empty frame log")
+        self.origin = keyframes[0][0]
+        self.level = level
+        self.mixType = mixType
+        self.loop = loop
+        self.path = path
+        self.lid = None
+        self.data = None
+        self.pending = None
+        self.timeout = None
+        # the values held by the merger layer
+        self.sent = ""
+
+        self.rewind(start)
+        frame = self.pending[1]
+        self.control = com.connectUnix(path, protoIn, protoOut)
+        com.send(self.control, {
+            "id": "layer",
+            "request": "new layer",
+            "layer": level,
+            "channels": self.channels(frame, 0),
+        })
+        self.sent = frame
+
+    def rewind(self, start):
+        """
+            Restart the playback at start seconds from the start of the
+            recording.
+        """
+        self.startTime = self.origin + start
+        self.frames = self.reader.frames(self.startTime)
+        self.pending = self.pull()
+        self.wallStart = time.time()
+
+    def pull(self):
+        """
+            @return: the next (time, frames) of the log, or None
+        """
+        for timestamp, frames in self.frames:
+            return timestamp, str(frames)
+        return None
+
+    def channels(self, frame, first):
+        """
+            @return: the channels of the universes of frame from the first
+            one, for new layer or new channels requests
+        """
+        channels = []
+        for univers in range(first, len(frame) // FRAME_SIZE):
+            base = univers * FRAME_SIZE
+            for offset in range(1, FRAME_SIZE):
+                channels.append({
+                    "address": univers * 512 + offset,
+                    "value": ord(frame[base + offset]),
+                    "mixType": self.mixType,
+                })
+        return channels
+
+    def onEvent(self, event):
+        if event[0] == "packet" and event[1] == self.control:
+            self.handleAnswer(event[2])
+        elif event[0] == "packet":
+            print >>sys.stderr, "merger: %s" % event[2]
+        elif event[0] == "timeout" and event[1] == ("frame",):
+            self.timeout = None
+            self.advance(time.time())
+        elif event[0] == "connection closed":
+            self.com.stop()
+
+    def handleAnswer(self, answer):
+        if answer.has_key("error"):
+            print >>sys.stderr, "merger: %s" % answer["error"]
+            return
+        if answer.get("id") == "layer":
+            self.lid = answer["lid"]
+            self.data = self.com.connectUnix(self.path, protoIn, None)
+            self.com.sendRaw(self.data, MAGIC)
+            self.wallStart = time.time()
+            self.schedule()
+
+    def advance(self, now):
+        """
+            Send the last frame due at now, and wait for the next one.
+        """
+        position = self.startTime + (now - self.wallStart)
+        frame = None
+        while self.pending is not None and self.pending[0] <= position:
+            frame = self.pending[1]
+            self.pending = self.pull()
+        if frame is not None:
+            self.sendFrame(frame)
+        if self.pending is None:
+            if not self.loop:
+                self.com.stop()
+                return
+            self.rewind(0.0)
+        self.schedule()
+
+    def schedule(self):
+        if self.pending is None or self.timeout is not None:
+            return
+        delay = self.wallStart + (self.pending[0] - self.startTime) - time.time()
+        self.timeout = self.com.setTimeout(max(0.0, delay), ("frame",))
+
+    def sendFrame(self, frame):
+        """
+            Send the channels of frame that changed since the last sent one.
+        """
+        old = self.sent
+        if len(frame) > len(old):
+            ## the recording has new universes
+            self.com.send(self.control, {
+                "id": "channels",
+                "request": "new channels",
+                "layer": self.level,
+                "channels": self.channels(frame, len(old) // FRAME_SIZE),
+            })
+        records = []
+        for base in range(0, min(len(old), len(frame)), FRAME_SIZE):
+            end = base + FRAME_SIZE
+            if old[base:end] == frame[base:end]:
+                continue
+            for offset in range(base + 1, end):
+                if old[offset] != frame[offset]:
+                    address = base // FRAME_SIZE * 512 + offset - base
+                    records.append(pack(self.lid, address, ord(frame[offset])))
+        if records:
+            self.com.sendRaw(self.data, "".join(records))
+        self.sent = frame
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] LOG")
+    parser.add_option("-l", "--layer", default="100", help="level of the played layer (default: %default)")
+    parser.add_option("-m", "--mix-type", default="1.0",
+        help="mixType of the layer channels, a float, min or max (default: %default)")
+    parser.add_option("-s", "--start", type="float", default=0.0,
+        help="start position, in seconds from the start of the recording")
+    parser.add_option("--loop", action="store_true", default=False)
+    parser.add_option("--merger", default=MERGER_SOCKET, help="merger socket (default: %default)")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("a frame log is needed")
+    try:
+        mixType = float(options.mix_type)
+    except ValueError:
+        mixType = options.mix_type
+
+    com = CommunicationManager()
+    reader = FrameLogReader(args[0])
+    Player(com, reader, options.layer, mixType, options.start, options.loop, options.merger)
+    com.main()
+    reader.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    Publication of the DMX galaxy in a memory mapped file, so that drivers
+    and monitoring tools can read the last merged frame without any socket.
+
+    File layout (native byte order):
+        - magic "LLGX"
+        - version (uint32)
+        - univers count (uint32)
+        - sequence (uint32)
+        - the universes, 513 bytes each (start code + 512 channels), as in
+          a DMXGalaxy
+
+    The sequence is a seqlock: it is odd while the writer updates the
+    universes. A reader copies the universes it needs between two reads of
+    an even and unchanged sequence, else it retries.
+
+    The C counterpart is in drivers/enttec_open_usb_dmx.c.
+"""
+
+import os
+import mmap
+import struct
+
+MAGIC = "LLGX"
+VERSION = 1
+HEADER = struct.Struct("=4sIII")
+SEQUENCE = struct.Struct("=I")
+SEQUENCE_OFFSET = 12
+FRAME_SIZE = 513
+
+DEFAULT_PATH = "/dev/shm/llgalaxy"
+DEFAULT_UNIVERSES = 16
+
+
+class SharedGalaxy(object):
+    """
+        Writer side, used by the merger.
+    """
+    def __init__(self, path=DEFAULT_PATH, universes=DEFAULT_UNIVERSES):
+        """
+            @param path: the file to map. It is created or resized.
+            @param universes: how many universes are published. Universes
+            beyond this count are not exported.
+        """
+        self.path = path
+        self.universes = universes
+        self.sequence = 0
+        size = HEADER.size + universes * FRAME_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.map[:size] = "\0" * size
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, universes, self.sequence)
+
+    def publish(self, galaxy):
+        """
+            Copy the galaxy universes in the shared file.
+        """
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+        offset = HEADER.size
+        for univers in galaxy.universes[:self.universes]:
+            self.map[offset:offset + FRAME_SIZE] = str(univers)
+            offset += FRAME_SIZE
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        self.map.close()
+
+
+class SharedGalaxyReader(object):
+    """
+        Reader side, for monitoring tools.
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version, self.universes, sequence = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s: not a shared galaxy file" % path)
+
+    def sequence(self):
+        """
+            @return: the current sequence. It changes at each publication.
+        """
+        return SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+
+    def read(self, univers=None):
+        """
+            Read a consistent copy of the published universes.
+            @param univers: the univers index to read, None for all of them
+            @return: (sequence, frame) where frame is the 513 bytes of the
+            univers, or the concatenation of all universes
+        """
+        if univers is None:
+            start, end = HEADER.size, HEADER.size + self.universes * FRAME_SIZE
+        elif 0 <= univers < self.universes:
+            start = HEADER.size + univers * FRAME_SIZE
+            end = start + FRAME_SIZE
+        else:
+            raise ValueError("Univers not published: %s" % univers)
+
+        while True:
+            before = self.sequence()
+            if before & 1:
+                continue
+            frame = self.map[start:end]
+            if self.sequence() == before:
+                return before, frame
+
+    def close(self):
+        self.map.close()
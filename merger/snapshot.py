@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    Binary snapshots of the merger state: the persistent layers, the master
+    groups and the merged galaxy (see Merger.saveSnapshot and
+    Merger.restore).
+
+    File layout (network byte order):
+        - header: magic "LLSN", version (uint32), time of the snapshot
+          (float64), grand master level (float64), layer count, master
+          count and univers count (uint32)
+        - for each layer: level length (uint16), channel count (uint32),
+          the level (utf-8), then the channels: address (uint32), value
+          (uint64), nbChan (uint8), mode (uint8, MIX, MIN or MAX), mix
+          factor (float64, only used with MIX)
+        - for each master: name length (uint16), channel count (uint32),
+          level (float64), the name (utf-8), then the channels: address
+          (uint32), nbChan (uint8)
+        - the universes, 513 bytes each, as in a DMXGalaxy
+        - the CRC32 of all the above (uint32)
+
+    Files are written to a temporary file then renamed, so a crash while
+    writing keeps the previous snapshot.
+"""
+
+import os
+import time
+import struct
+import zlib
+
+MAGIC = "LLSN"
+VERSION = 1
+HEADER = struct.Struct("!4sIddIII")
+LAYER = struct.Struct("!HI")
+CHANNEL = struct.Struct("!IQBBd")
+MASTER = struct.Struct("!HId")
+MASTER_CHANNEL = struct.Struct("!IB")
+CRC = struct.Struct("!I")
+FRAME_SIZE = 513
+
+MIX = 0
+MIN = 1
+MAX = 2
+
+modes = {
+    MIN: "min",
+    MAX: "max",
+}
+mixTypes = dict((mixType, mode) for mode, mixType in modes.items())
+
+
+class Snapshot(object):
+    """
+        The content of a snapshot file.
+    """
+    def __init__(self, layers=None, masters=None, grand=1.0, universes=None, when=None):
+        """
+            @param layers: (level, channels) tuples, from the lowest layer,
+            channels being (address, value, mixType, nbChan) tuples
+            @param masters: (name, level, channels) tuples, channels being
+            an address -> nbChan dict
+            @param grand: the grand master level
+            @param universes: the merged universes, 513 bytes each
+            @param when: the snapshot time, now by default
+        """
+        self.layers = layers or []
+        self.masters = masters or []
+        self.grand = grand
+        self.universes = universes or []
+        self.time = time.time() if when is None else when
+
+    def pack(self):
+        parts = [HEADER.pack(MAGIC, VERSION, self.time, self.grand,
+            len(self.layers), len(self.masters), len(self.universes))]
+        for level, channels in self.layers:
+            level = level.encode("utf-8")
+            parts.append(LAYER.pack(len(level), len(channels)))
+            parts.append(level)
+            for address, value, mixType, nbChan in channels:
+                if mixType in mixTypes:
+                    parts.append(CHANNEL.pack(address, value, nbChan, mixTypes[mixType], 0.0))
+                else:
+                    parts.append(CHANNEL.pack(address, value, nbChan, MIX, mixType))
+        for name, level, channels in self.masters:
+            name = name.encode("utf-8")
+            parts.append(MASTER.pack(len(name), len(channels), level))
+            parts.append(name)
+            for address, nbChan in channels.items():
+                parts.append(MASTER_CHANNEL.pack(address, nbChan))
+        for univers in self.universes:
+            parts.append(str(univers))
+        data = "".join(parts)
+        return data + CRC.pack(zlib.crc32(data) & 0xffffffff)
+
+    @classmethod
+    def unpack(cls, data):
+        if len(data) < HEADER.size + CRC.size:
+            raise ValueError("Truncated snapshot")
+        if CRC.unpack_from(data, len(data) - CRC.size)[0] != zlib.crc32(data[:-CRC.size]) & 0xffffffff:
+            raise ValueError("Corrupted snapshot")
+        magic, version, when, grand, layerCount, masterCount, universCount = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a snapshot")
+        offset = HEADER.size
+
+        layers = []
+        for i in xrange(layerCount):
+            length, count = LAYER.unpack_from(data, offset)
+            offset += LAYER.size
+            level = data[offset:offset + length].decode("utf-8")
+            offset += length
+            channels = []
+            for j in xrange(count):
+                address, value, nbChan, mode, factor = CHANNEL.unpack_from(data, offset)
+                offset += CHANNEL.size
+                channels.append((address, value, factor if mode == MIX else modes[mode], nbChan))
+            layers.append((level, channels))
+
+        masters = []
+        for i in xrange(masterCount):
+            length, count, level = MASTER.unpack_from(data, offset)
+            offset += MASTER.size
+            name = data[offset:offset + length].decode("utf-8")
+            offset += length
+            channels = {}
+            for j in xrange(count):
+                address, nbChan = MASTER_CHANNEL.unpack_from(data, offset)
+                offset += MASTER_CHANNEL.size
+                channels[address] = nbChan
+            masters.append((name, level, channels))
+
+        universes = []
+        for i in xrange(universCount):
+            universes.append(bytearray(data[offset:offset + FRAME_SIZE]))
+            offset += FRAME_SIZE
+        if offset != len(data) - CRC.size:
+            raise ValueError("Bad snapshot size")
+        return cls(layers, masters, grand, universes, when)
+
+    def write(self, path):
+        """
+            Atomically replace the file at path by this snapshot.
+        """
+        temporary = path + ".tmp"
+        f = open(temporary, "wb")
+        try:
+            f.write(self.pack())
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temporary, path)
+
+    @classmethod
+    def read(cls, path):
+        f = open(path, "rb")
+        try:
+            return cls.unpack(f.read())
+        finally:
+            f.close()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    Cheap counters and histograms for the merger hot paths (see the "stats"
+    request).
+"""
+
+import time
+
+
+class Histogram(object):
+    """
+        Histogram with power of two buckets: bucket i counts the values v
+        such that 2 ** (i - 1) <= v < 2 ** i (bucket 0 counts 0).
+
+        Durations are recorded in microseconds.
+    """
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        """
+            @param value: a positive integer
+        """
+        self.buckets[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def addDuration(self, seconds):
+        self.add(int(seconds * 1000000))
+
+    def percentile(self, p):
+        """
+            @return: an upper bound of the p (0 to 100) percentile
+        """
+        if self.count == 0:
+            return 0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(2 ** i - 1, self.max)
+        return self.max
+
+    def toDict(self):
+        return {
+            "count": self.count,
+            "mean": float(self.total) / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            ## [upper bound, count] of the non empty buckets
+            "buckets": [[2 ** i - 1, count] for i, count in enumerate(self.buckets) if count],
+        }
+
+
+class MergerStats(object):
+    """
+        Statistics kept by a Merger.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        ## request handling time, in us
+        self.dispatch = Histogram()
+        ## merge time, in us
+        self.merge = Histogram()
+        ## channels mixed by each merge
+        self.mixed = Histogram()
+        ## time to send the merged universes to outputs, in us
+        self.output = Histogram()
+        ## request name -> count
+        self.requests = {}
+
+    def toDict(self):
+        return {
+            "since": self.since,
+            "dispatch": self.dispatch.toDict(),
+            "merge": self.merge.toDict(),
+            "mixed": self.mixed.toDict(),
+            "output": self.output.toDict(),
+            "requests": dict(self.requests),
+        }
@@ -2,8 +2,79 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import random
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+from merger import Layer, Merger, Channel, FRAME_RATE
+from sharedgalaxy import SharedGalaxyReader
+from stats import Histogram
+import masters
+from framelog import FrameLogWriter, FrameLogReader
+from framelogtool import summary
+from player import Player
+from common.binaryprotocol import BinaryProtocol, pack, MAGIC, RECORD, negotiate
+from common.jsonprotocol import protoIn, protoOut
+from common.communicationmanager import CommunicationManager
+
+try:
+    from numpyengine import NumpyEngine
+except ImportError:
+    NumpyEngine = None
+
+try:
+    from common.asynciocommunicationmanager import AsyncioCommunicationManager, asyncio
+except ImportError:
+    AsyncioCommunicationManager = None
+
+class FakeCom(object):
+    """
+        Stands for a CommunicationManager: records timeouts and sent data.
+    """
+    def __init__(self):
+        self.timeouts = []
+        self.sent = []
+        self.fds = {}
+
+    def registerHighLevelListener(self, listener):
+        pass
+
+    def setTimeout(self, timeout, payload=None):
+        self.timeouts.append((timeout, payload))
+        return len(self.timeouts) - 1
+
+    def send(self, cid, data):
+        self.sent.append((cid, data))
+
+    def addFDescriptor(self, fd, protoIn=None, protoOut=None, dontClose=True, hold=False):
+        self.fds[fd] = 0
+
+    def removeFDescriptor(self, fd):
+        del self.fds[fd]
+
+    def sendRaw(self, cid, data):
+        self.sent.append((cid, data))
+        self.fds[cid] += len(data)
+
+    def outDataLen(self, cid):
+        return self.fds[cid]
+
+    def connectUnix(self, address="/tmp", protoIn=None, protoOut=None):
+        cid = 100 + len(self.fds)
+        self.fds[cid] = 0
+        return cid
+
+    def stop(self):
+        self.stopped = True
+
+    def fire(self, handler):
+        timeouts, self.timeouts = self.timeouts, []
+        for timeout, payload in timeouts:
+            handler.onEvent(("timeout", payload))
 
-from merger import Layer, Merger, Channel
 
 class LayerTests(unittest.TestCase):
 
@@ -65,6 +136,13 @@ class LayerTests(unittest.TestCase):
             self.fail()
 
 
+    def test_slots(self):
+        l = Layer("1")
+        l.addChannel(1, 255)
+        self.assertRaises(AttributeError, setattr, l.channels[1], "other", 1)
+        self.assertRaises(AttributeError, setattr, l, "other", 1)
+        self.assertEqual((l.status, l.cid, l.lid), ("volatile", None, None))
+
     def test_ordering_simple(self):
         l2 = Layer("2")
         l1 = Layer("1")
@@ -145,6 +223,17 @@ class MergerTests(unittest.TestCase):
 
         m.delLayer(l2)
         m.delLayer(l)
+        self.assertEqual(m.layers, [])
+
+        m = Merger()
+        levels = ["2", "-1", "1.1", "1", "2.-1", "1.1", "10"]
+        for level in levels:
+            m.addLayer(Layer(level))
+        self.assertEqual([l.level for l in m.layers], ["1", "1.1", "2", "2.-1", "10", "-1"])
+        self.assertEqual(m.getLayer("1.1").level, "1.1")
+        m.delLayer("2")
+        self.assertEqual([l.level for l in m.layers], ["1", "1.1", "2.-1", "10", "-1"])
+        self.assertRaises(ValueError, m.getLayer, "2")
 
     def test_merge_simple(self):
         m = Merger()
@@ -189,6 +278,1009 @@ class MergerTests(unittest.TestCase):
         self.assertEqual(m.galaxy[4], 255)
         self.assertEqual(m.galaxy[5], 0)
 
+    def test_merge_dirty(self):
+        m = Merger()
+        requests = [
+            {"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "2", "value": "1"},
+                {"address": "3", "value": "255"},
+                {"address": "10", "value": "4660", "nbChan": "2"},
+            ]},
+            {"id": "2", "request": "new layer", "layer": "2", "channels": [
+                {"address": "3", "value": 0, "mixType": 0.5},
+                {"address": "11", "value": 200, "mixType": "max"},
+            ]},
+            {"id": "3", "request": "update channels", "layer": "1", "channels": [
+                {"address": "10", "value": "65535"},
+            ]},
+            {"id": "4", "request": "update channels", "layer": "2", "channels": [
+                {"address": "3", "mixType": 0.25},
+            ]},
+            {"id": "5", "request": "remove channels", "layer": "1", "channels": [
+                {"address": "2"},
+            ]},
+        ]
+        for request in requests:
+            r = m.handleRequest(request, 1)
+            self.assertFalse("error" in r, r)
+            incremental = [bytearray(u) for u in m.galaxy.universes]
+            m.merge()
+            self.assertEqual(incremental, m.galaxy.universes)
+
+        m.handleRequest({"id": "6", "request": "remove layer", "layer": "2"}, 1)
+        self.assertEqual(m.galaxy[3], 255)
+        self.assertEqual(m.galaxy[11], 255)
+
+    def test_channel_checks(self):
+        m = Merger()
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "10"},
+        ]}, 1)
+        for channel in (
+                {"address": "2", "value": "1", "nbChan": "4096"},
+                {"address": "2", "value": "1", "nbChan": "0"},
+                {"address": "2", "value": "1", "mixType": "sum"},
+                {"address": "2", "value": "1", "mixType": "nan"},
+                {"address": "2", "value": "1", "mixType": "inf"}):
+            ## the first channel is valid: nothing is applied
+            r = m.handleRequest({"id": "2", "request": "new channels", "layer": "1", "channels": [
+                {"address": "3", "value": "30"}, channel,
+            ]}, 1)
+            self.assertTrue("error" in r, channel)
+            r = m.handleRequest({"id": "3", "request": "new layer", "layer": "1", "channels": [channel]}, 1)
+            self.assertTrue("error" in r, channel)
+        self.assertEqual(sorted(m.getLayer("1").channels), [1])
+        self.assertEqual(m.maxNbChan, 1)
+
+        r = m.handleRequest({"id": "4", "request": "update channels", "layer": "1", "channels": [
+            {"address": "1", "value": "20"}, {"address": "1", "mixType": "nan"},
+        ]}, 1)
+        self.assertTrue("error" in r)
+        r = m.handleRequest({"id": "5", "request": "update channels", "layer": "1", "channels": [
+            {"address": "1", "value": "20", "mixType": "max"},
+        ]}, 1)
+        self.assertFalse("error" in r, r)
+        self.assertEqual(m.galaxy[1], 20)
+
+    def test_address_limit(self):
+        m = Merger(universes=2)
+        for address, nbChan in (("4000000000", 1), ("1025", 1), ("1024", 2), ("0", 1)):
+            r = m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": address, "value": "10", "nbChan": nbChan},
+            ]}, 1)
+            self.assertTrue("error" in r, address)
+        r = m.handleRequest({"id": "2", "request": "new master", "master": "m", "channels": [
+            {"address": "1025"},
+        ]}, 1)
+        self.assertTrue("error" in r)
+        self.assertEqual(m.galaxy.universes, [])
+
+        r = m.handleRequest({"id": "3", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1023", "value": "10", "nbChan": 2},
+        ]}, 1)
+        self.assertFalse("error" in r, r)
+        self.assertEqual(len(m.galaxy.universes), 2)
+
+    def checkRandomRequests(self, m, seed, settle=None):
+        """
+            Send random layer and channel requests to m, and check its output
+            against a full merge after each one.
+            @param settle: called with m and the random generator before each
+            request
+        """
+        rand = random.Random(seed)
+        mixTypes = (0.5, 1.0, 0.2, "min", "max")
+        for i in range(300):
+            level = str(rand.randrange(1, 6))
+            address = rand.randrange(1, 30)
+            action = rand.randrange(5)
+            if action == 0:
+                request = {"request": "new layer", "layer": level, "channels": [
+                    {"address": a, "value": rand.randrange(256), "mixType": rand.choice(mixTypes)}
+                    for a in rand.sample(range(1, 30), 5)
+                ]}
+            elif action == 1:
+                request = {"request": "new channels", "layer": level, "channels": [
+                    {"address": address, "value": rand.randrange(65536), "nbChan": rand.choice((1, 2)),
+                     "mixType": rand.choice(mixTypes)},
+                ]}
+            elif action == 2:
+                request = {"request": "update channels", "layer": level, "channels": [
+                    {"address": address, "value": rand.randrange(256), "mixType": rand.random()},
+                ]}
+            elif action == 3:
+                request = {"request": "remove channels", "layer": level, "channels": [
+                    {"address": address},
+                ]}
+            else:
+                request = {"request": "remove layer", "layer": level}
+            request["id"] = str(i)
+            if settle is not None:
+                settle(m, rand)
+            m.handleRequest(request, 1)
+            reference = Merger()
+            reference.layers = list(m.layers)
+            reference.merge()
+            for address in range(1, 32):
+                self.assertEqual(m.galaxy[address], reference.galaxy[address], request)
+
+    def test_merge_plans(self):
+        self.checkRandomRequests(Merger(), 1)
+
+    def test_merge_prefix(self):
+        m = Merger()
+        for level in ("1", "2", "3"):
+            m.handleRequest({"id": level, "request": "new layer", "layer": level, "channels": [
+                {"address": 1, "value": 100 * int(level), "mixType": 0.5},
+                {"address": 2, "value": 10 * int(level), "mixType": "max", "nbChan": 2},
+            ]}, 1)
+        self.assertEqual(m.prefix, None)
+
+        ## layers 1 and 2 are static
+        for layer in m.layers[:2]:
+            layer.changedAt = 0
+        m.prefixCheck = 0
+        m.stats.reset()
+        m.handleRequest({"id": "4", "request": "update channels", "layer": "3", "channels": [
+            {"address": 1, "value": 50},
+        ]}, 1)
+        self.assertEqual(m.prefixKey, m.getLayer("3").key)
+        self.assertEqual(m.prefix[1], 125)
+        ## only the channel of layer 3 is mixed
+        self.assertEqual(m.stats.mixed.total, 1)
+        self.assertEqual(m.galaxy[1], 88)
+
+        ## a change under the prefix drops it
+        m.handleRequest({"id": "5", "request": "update channels", "layer": "1", "channels": [
+            {"address": 2, "value": 65535},
+        ]}, 1)
+        self.assertEqual(m.prefix, None)
+        self.assertEqual((m.galaxy[2], m.galaxy[3]), (255, 255))
+
+        def settle(m, rand):
+            ## let some of the lowest layers settle
+            for layer in m.layers[:rand.randrange(len(m.layers) + 1)]:
+                layer.changedAt = 0
+            m.prefixCheck = 0
+        self.checkRandomRequests(m, 2, settle)
+
+    def test_remove_channels_prefix(self):
+        m = Merger()
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": 1, "value": 100},
+            {"address": 2, "value": 50},
+        ]}, 1)
+        m.handleRequest({"id": "2", "request": "new layer", "layer": "2", "channels": [
+            {"address": 3, "value": 10},
+        ]}, 1)
+        ## layer 1 is static, in the prefix
+        m.getLayer("1").changedAt = 0
+        m.prefixCheck = 0
+        m.handleRequest({"id": "3", "request": "update channels", "layer": "2", "channels": [
+            {"address": 3, "value": 20},
+        ]}, 1)
+        self.assertEqual(m.prefixKey, m.getLayer("2").key)
+
+        ## a missing address rejects the whole request
+        r = m.handleRequest({"id": "4", "request": "remove channels", "layer": "1", "channels": [
+            {"address": 1}, {"address": 99},
+        ]}, 1)
+        self.assertTrue("error" in r)
+        self.assertEqual(sorted(m.getLayer("1").channels), [1, 2])
+
+        r = m.handleRequest({"id": "5", "request": "remove channels", "layer": "1", "channels": [
+            {"address": 1}, {"address": 1},
+        ]}, 1)
+        self.assertFalse("error" in r)
+        m.handleRequest({"id": "6", "request": "update channels", "layer": "2", "channels": [
+            {"address": 3, "value": 30},
+        ]}, 1)
+        reference = Merger()
+        reference.layers = list(m.layers)
+        reference.merge()
+        self.assertEqual(m.galaxy.universes, reference.galaxy.universes)
+        self.assertEqual(m.galaxy[1], 0)
+
+    def test_galaxy(self):
+        m = Merger()
+        l = Layer("1")
+        l.addChannel(512, 1)
+        l.addChannel(513, 2)
+        l.addChannel(1024, 258, nbChan=2)
+        m.addLayer(l)
+        m.merge()
+
+        self.assertEqual(len(m.galaxy.universes), 3)
+        self.assertEqual(m.galaxy.universes[0][512], 1)
+        self.assertEqual(m.galaxy.universes[1][0], 0)
+        self.assertEqual(m.galaxy.universes[1][1], 2)
+        self.assertEqual(m.galaxy.universes[1][512], 1)
+        self.assertEqual(m.galaxy.universes[2][1], 2)
+        self.assertEqual(m.galaxy[1025], 2)
+        self.assertEqual(m.galaxy[5000], 0)
+
+        r = m.handleRequest({"id": "1", "request": "output"}, 1)
+        self.assertEqual(len(r["output"]), 3)
+        self.assertEqual(len(r["output"][0]), 512)
+        self.assertEqual(r["output"][1][0], 2)
+
+        self.assertRaises(ValueError, l.addChannel, 0, 1)
+
+    def test_merge_scheduler(self):
+        com = FakeCom()
+        m = Merger(com, rate=40)
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "10"},
+        ]}, 1)
+        for value in (20, 30, 40):
+            m.handleRequest({"id": "2", "request": "update channels", "layer": "1", "channels": [
+                {"address": "1", "value": value},
+            ]}, 1)
+        self.assertEqual(m.galaxy[1], 0)
+        self.assertEqual(len(com.timeouts), 1)
+        self.assertTrue(com.timeouts[0][0] <= 1.0 / 40)
+
+        com.fire(m)
+        self.assertEqual(m.galaxy[1], 40)
+        stats = m.handleRequest({"id": "3", "request": "scheduler"}, 1)["data"]
+        self.assertEqual(stats["merges"], 1)
+        self.assertEqual(stats["coalescing"], 4.0)
+
+        m.handleRequest({"id": "4", "request": "update channels", "layer": "1", "channels": [
+            {"address": "1", "value": 50},
+        ]}, 1)
+        self.assertTrue(0 < com.timeouts[0][0] <= 1.0 / 40)
+
+        r = m.handleRequest({"id": "5", "request": "scheduler", "rate": 0}, 1)
+        self.assertTrue("error" in r)
+
+    def test_fade(self):
+        com = FakeCom()
+        m = Merger(com)
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "0"},
+            {"address": "2", "value": "100", "mixType": 0.0},
+        ]}, 1)
+        r = m.handleRequest({"id": "2", "request": "fade", "layer": "1", "duration": 2, "channels": [
+            {"address": "1", "value": 200},
+        ]}, 1)
+        self.assertEqual(r, {"id": "2", "status": "ok"})
+        self.assertEqual(com.timeouts, [(1.0 / 44, ("fade",))])
+        m.advanceFades(m.fades[0].start + 0.5)
+        m.mergeDirty()
+        self.assertEqual(m.galaxy[1], 50)
+
+        ## the whole layer crossfades, the first fade loses its channel
+        m.handleRequest({"id": "3", "request": "fade", "layer": "1", "duration": 1, "mixType": 0.5}, 1)
+        crossfade = m.fades[1]
+        m.advanceFades(crossfade.start + 0.5)
+        m.mergeDirty()
+        self.assertEqual(com.sent, [(1, {"id": "2", "status": "cancelled"})])
+        self.assertEqual((m.galaxy[1], m.galaxy[2]), (38, 25))
+
+        ## "max" is set at the end of the fade
+        m.handleRequest({"id": "4", "request": "fade", "layer": "1", "duration": 0, "channels": [
+            {"address": "2", "value": 10, "mixType": "max"},
+        ]}, 1)
+        crossfade.start -= 1
+        com.fire(m)
+        self.assertEqual((m.galaxy[1], m.galaxy[2]), (25, 10))
+        self.assertEqual(com.sent[1:], [
+            (1, {"id": "3", "status": "complete"}),
+            (1, {"id": "4", "status": "complete"}),
+        ])
+        self.assertEqual(m.fades, [])
+        self.assertEqual(com.timeouts, [])
+
+        r = m.handleRequest({"id": "5", "request": "fade", "layer": "1", "duration": 1, "mixType": "sum"}, 1)
+        self.assertTrue("error" in r)
+
+        ## non finite mixTypes and durations are rejected, per channel and
+        ## for the whole layer, even without channels
+        m.handleRequest({"id": "6", "request": "new layer", "layer": "2"}, 1)
+        for mixType in ("nan", "inf", float("-inf")):
+            for request in (
+                {"layer": "1", "duration": 1, "mixType": mixType},
+                {"layer": "2", "duration": 1, "mixType": mixType},
+                {"layer": "1", "duration": 1, "channels": [{"address": "1", "mixType": mixType}]},
+                {"layer": "1", "duration": mixType, "value": 0},
+            ):
+                r = m.handleRequest(dict(request, id="7", request="fade"), 1)
+                self.assertTrue("error" in r, request)
+        self.assertEqual(m.fades, [])
+        r = m.handleRequest({"id": "8", "request": "update channels", "layer": "1", "channels": [
+            {"address": "1", "value": "30"},
+        ]}, 1)
+        self.assertFalse("error" in r)
+        com.fire(m)
+        self.assertEqual(m.galaxy[1], 15)
+
+    def test_masters(self):
+        withNumpy = masters.numpy
+        try:
+            for masters.numpy in set([withNumpy, None]):
+                self.check_masters()
+        finally:
+            masters.numpy = withNumpy
+
+    def check_masters(self):
+        m = Merger()
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "200"},
+            {"address": "2", "value": "100"},
+            {"address": "10", "value": "4660", "nbChan": "2"},
+            {"address": "600", "value": "255"},
+        ]}, 1)
+        r = m.handleRequest({"id": "2", "request": "new master", "master": "front", "level": 0.5, "channels": [
+            {"address": "1"},
+            {"address": "10", "nbChan": "2"},
+        ]}, 1)
+        self.assertEqual(r, {"id": "2", "status": "ok"})
+        output = m.handleRequest({"id": "3", "request": "output"}, 1)["output"]
+        self.assertEqual(output[0][:2], [100, 100])
+        self.assertEqual(output[0][9:11], [0x09, 0x1a])
+        self.assertEqual(m.galaxy[1], 200)
+
+        m.handleRequest({"id": "4", "request": "grand master", "level": 0.5}, 1)
+        galaxy = m.outputGalaxy()
+        self.assertEqual((galaxy[1], galaxy[2], galaxy[600]), (50, 50, 128))
+
+        m.handleRequest({"id": "5", "request": "master level", "master": "front", "level": 1}, 1)
+        self.assertEqual((galaxy[1], galaxy[10], galaxy[11]), (100, 0x09, 0x1a))
+
+        m.handleRequest({"id": "6", "request": "update channels", "layer": "1", "channels": [
+            {"address": "1", "value": "100"},
+        ]}, 1)
+        self.assertEqual(galaxy[1], 50)
+
+        r = m.handleRequest({"id": "7", "request": "master level", "master": "front", "level": 2}, 1)
+        self.assertTrue("error" in r)
+        m.handleRequest({"id": "8", "request": "remove master", "master": "front"}, 1)
+        m.handleRequest({"id": "9", "request": "grand master", "level": 1}, 1)
+        self.assertTrue(m.outputGalaxy() is m.galaxy)
+        r = m.handleRequest({"id": "10", "request": "remove master", "master": "front"}, 1)
+        self.assertTrue("error" in r)
+
+    def test_batch(self):
+        com = FakeCom()
+        m = Merger(com, rate=40)
+        r = m.handleRequest({"id": "1", "request": "batch", "operations": [
+            {"request": "new layer", "layer": "1", "channels": [
+                {"address": "1", "value": "10"},
+            ]},
+            {"request": "new layer", "layer": "2", "channels": [
+                {"address": "1", "value": "100", "mixType": "max"},
+            ]},
+            {"request": "update channels", "layer": "3", "channels": [
+                {"address": "1", "value": "100"},
+            ]},
+            {"request": "status"},
+            {"request": "update channels", "layer": "1", "channels": [
+                {"address": "1", "value": "200"},
+            ]},
+        ]}, 1)
+        self.assertTrue("error" in r)
+        self.assertEqual([result.has_key("error") for result in r["results"]],
+            [False, False, True])
+        self.assertEqual(r["results"][0]["status"], "ok")
+        self.assertEqual(m.layers, [])
+        self.assertEqual(m.layerIds, {})
+        com.fire(m)
+        requests = m.scheduler.requests
+
+        r = m.handleRequest({"id": "2", "request": "batch", "operations": [
+            {"request": "new layer", "layer": "1", "channels": [
+                {"address": "1", "value": "10"},
+            ]},
+            {"request": "new layer", "layer": "2", "channels": [
+                {"address": "1", "value": "100", "mixType": "max"},
+            ]},
+            {"request": "update channels", "layer": "1", "channels": [
+                {"address": "1", "value": "200"},
+            ]},
+        ]}, 1)
+        self.assertEqual(r["status"], "ok")
+        self.assertEqual([result["status"] for result in r["results"]], ["ok"] * 3)
+        self.assertEqual(len(com.timeouts), 1)
+        self.assertEqual(m.scheduler.requests, requests + 1)
+        com.fire(m)
+        self.assertEqual(m.galaxy[1], 200)
+
+        ## a failing batch rolls back the changes of its operations
+        lids = dict((layer.level, layer.lid) for layer in m.layers)
+        for operations in (
+            [{"request": "status"}],
+            ["junk"],
+            [{"request": "update channels", "layer": "1", "channels": [{"address": "1", "value": "5"}]},
+             {"request": "remove layer", "layer": "2"},
+             {"request": "new layer", "layer": "2", "channels": [{"address": "2", "value": "7"}]},
+             {"request": "new layer", "layer": "3", "channels": [{"address": "3", "value": "7"}]},
+             {"request": "new channels", "layer": "1", "channels": [{"address": "4", "value": "7"}]},
+             {"request": "fade", "layer": "1", "duration": 1, "value": "0"},
+             {"request": "remove channels", "layer": "1", "channels": [{"address": "4"}, {"address": "9"}]}],
+        ):
+            r = m.handleRequest({"id": "3", "request": "batch", "operations": operations}, 1)
+            self.assertTrue("error" in r)
+            self.assertTrue("error" in r["results"][-1])
+            self.assertEqual(dict((layer.level, layer.lid) for layer in m.layers), lids)
+            self.assertEqual(m.layerIndex["1"].channels.keys(), [1])
+            self.assertEqual(m.layerIndex["2"].channels.keys(), [1])
+            self.assertEqual(m.fades, [])
+            com.fire(m)
+            self.assertEqual(m.galaxy.universes[0][1:5], bytearray([200, 0, 0, 0]))
+        self.assertEqual(m.layerKeys, [layer.key for layer in m.layers])
+        self.assertEqual(sorted(m.cidLayers[1]), m.layers)
+
+        r = m.handleRequest({"id": "4", "request": "batch"}, 1)
+        self.assertTrue("error" in r)
+        self.assertFalse(m.batching)
+
+    def test_binary_updates(self):
+        com = FakeCom()
+        m = Merger(com)
+        r = m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "10"},
+            {"address": "2", "value": "10", "nbChan": 2},
+        ]}, 1)
+        lid = r["lid"]
+        r = m.handleRequest({"id": "2", "request": "new layer", "layer": "2"}, 1)
+        self.assertNotEqual(r["lid"], lid)
+
+        data = pack(lid, 1, 20, "max") + pack(lid, 2, 0x10203) + pack(lid, 5, 1)
+        updates, consumed = BinaryProtocol().parse(data)
+        m.onEvent(("packet", 3, updates))
+        self.assertEqual(m.galaxy[1], 20)
+        self.assertEqual(m.layerIds[lid].channels[1].mixType, "max")
+        self.assertEqual(m.galaxy[2], 2)
+        self.assertEqual(m.galaxy[3], 3)
+        self.assertEqual(len(com.sent), 1)
+        self.assertEqual(com.sent[0][0], 3)
+        self.assertEqual(len(com.sent[0][1]["errors"]), 1)
+        com.sent = []
+
+        ## bad modes and mix factors are reported, and not applied
+        data = RECORD.pack(lid, 1, 30, 7, 0.0) + pack(lid, 1, 30, float("nan"))
+        updates, consumed = BinaryProtocol().parse(data)
+        m.onEvent(("packet", 3, updates))
+        self.assertEqual(com.sent, [(3, {"errors": ["Bad mode: %d 1 7" % lid, "Bad mix factor: %d 1 nan" % lid]})])
+        errors = m.channelUpdates([(lid, 1, 30, "sum"), (lid, 1, 30, float("inf"))])
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(m.layerIds[lid].channels[1].mixType, "max")
+        m.merge()
+        self.assertEqual(m.galaxy[1], 20)
+
+        m.delLayer("1")
+        self.assertFalse(lid in m.layerIds)
+
+    def test_subscribe_output(self):
+        com = FakeCom()
+        m = Merger(com, rate=40)
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "10"},
+            {"address": "3", "value": "30"},
+            {"address": "20", "value": "20"},
+            {"address": "515", "value": "5"},
+        ]}, 1)
+        com.fire(m)
+        r = m.handleRequest({"id": "s", "request": "subscribe output", "rate": 10}, 2)
+        self.assertEqual(r["status"], "ok")
+        com.fire(m)
+        self.assertEqual(com.sent, [(2, {"id": "s", "changes": [
+            [1, [10, 0, 30]], [20, [20]], [515, [5]],
+        ]})])
+        com.sent = []
+
+        ## rate limited: the change is sent later
+        m.handleRequest({"id": "2", "request": "update channels", "layer": "1", "channels": [
+            {"address": "3", "value": "31"},
+        ]}, 1)
+        com.fire(m)
+        self.assertEqual(com.sent, [])
+        self.assertEqual(len(com.timeouts), 1)
+        m.subscriptions[2].lastSent = 0
+        com.fire(m)
+        self.assertEqual(com.sent, [(2, {"id": "s", "changes": [[3, [31]]]})])
+        com.sent = []
+
+        ## nothing changed, nothing sent
+        m.updateUnivers()
+        self.assertEqual(com.sent, [])
+        self.assertEqual(com.timeouts, [])
+
+        m.onEvent(("connection closed", 2))
+        self.assertEqual(m.subscriptions, {})
+
+    def test_subscribe_output_unscheduled(self):
+        com = FakeCom()
+        m = Merger(com)
+        m.handleRequest({"id": "s", "request": "subscribe output", "rate": 10}, 2)
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "10"},
+        ]}, 1)
+        self.assertEqual(com.sent, [(2, {"id": "s", "changes": [[1, [10]]]})])
+        com.sent = []
+
+        ## rate limited: a timeout sends the change when the period is over
+        m.handleRequest({"id": "2", "request": "update channels", "layer": "1", "channels": [
+            {"address": "1", "value": "11"},
+        ]}, 1)
+        self.assertEqual(com.sent, [])
+        self.assertEqual(len(com.timeouts), 1)
+        delay, payload = com.timeouts[0]
+        self.assertEqual(payload, ("output",))
+        self.assertTrue(0 < delay <= 0.1)
+        m.subscriptions[2].lastSent -= 0.1
+        com.fire(m)
+        self.assertEqual(com.sent, [(2, {"id": "s", "changes": [[1, [11]]]})])
+        self.assertEqual(com.timeouts, [])
+
+    def test_closed_connection(self):
+        m = Merger()
+        for i in range(60):
+            cid = 1 + i % 3
+            m.handleRequest({"id": str(i), "request": "new layer", "layer": str(i),
+                "status": "persistent" if i % 4 == 0 else "volatile",
+                "channels": [{"address": str(1 + i), "value": "100"}]}, cid)
+        ## replaced by another connection
+        m.handleRequest({"id": "a", "request": "new layer", "layer": "1", "channels": [
+            {"address": "2", "value": "100"},
+        ]}, 3)
+        self.assertEqual(len(m.cidLayers[1]), 15)
+        self.assertEqual(len(m.cidLayers[2]), 14)
+
+        merges = m.stats.merge.count
+        m.onEvent(("connection closed", 1))
+        self.assertEqual(m.stats.merge.count, merges + 1)
+        self.assertFalse(1 in m.cidLayers)
+        levels = [layer.level for layer in m.layers]
+        self.assertEqual(levels, sorted(levels, key=lambda level: int(level)))
+        self.assertEqual(m.layerKeys, [layer.key for layer in m.layers])
+        self.assertEqual(len(m.layers), 60 - 15)
+        for i in range(60):
+            owned = i % 3 == 0 and i % 4 != 0
+            self.assertEqual(str(i) in m.layerIndex, not owned)
+            self.assertEqual(m.galaxy[1 + i], 0 if owned else 100)
+
+        m.onEvent(("connection closed", 3))
+        self.assertEqual(sorted(m.cidLayers), [2])
+        self.assertEqual(m.getLayer("0").status, "persistent")
+
+    def test_stats(self):
+        m = Merger()
+        m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+            {"address": "1", "value": "10"},
+            {"address": "2", "value": "10"},
+        ]}, 1)
+        m.handleRequest({"id": "2", "request": "update channels", "layer": "1", "channels": [
+            {"address": "2", "value": "20"},
+        ]}, 1)
+        m.merge()
+        data = m.handleRequest({"id": "3", "request": "stats", "reset": True}, 1)["data"]
+        self.assertEqual(data["requests"], {"new layer": 1, "update channels": 1})
+        self.assertEqual(data["dispatch"]["count"], 2)
+        self.assertEqual(data["merge"]["count"], 3)
+        self.assertEqual(data["mixed"]["max"], 2)
+        self.assertEqual(sum(count for bound, count in data["mixed"]["buckets"]), 3)
+
+        data = m.handleRequest({"id": "4", "request": "stats"}, 1)["data"]
+        self.assertEqual(data["requests"], {"stats": 1})
+        self.assertEqual(data["merge"]["count"], 0)
+
+        h = Histogram()
+        for value in (0, 1, 3, 5, 100):
+            h.add(value)
+        self.assertEqual(h.percentile(50), 3)
+        self.assertEqual(h.percentile(100), 100)
+        self.assertEqual(h.toDict()["buckets"], [[0, 1], [1, 1], [3, 1], [7, 1], [127, 1]])
+
+    def test_driver_output(self):
+        com = FakeCom()
+        m = Merger(com, rate=40)
+        pin, pout = os.pipe()
+        try:
+            output = m.attachDriver(1, pout)
+            self.assertEqual(com.sent, [(pout, "\0" * 513)])
+            com.fds[pout] = 0
+            com.sent = []
+
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "1", "value": "10"},
+                {"address": "513", "value": "20"},
+            ]}, 1)
+            com.fire(m)
+            self.assertEqual(len(com.sent), 1)
+            self.assertEqual(com.sent[0][1], "\0\x14" + "\0" * 511)
+            com.sent = []
+
+            ## unchanged univers 1 is not sent again
+            m.handleRequest({"id": "2", "request": "update channels", "layer": "1", "channels": [
+                {"address": "1", "value": "11"},
+            ]}, 1)
+            com.fire(m)
+            self.assertEqual(com.sent, [])
+
+            ## the driver is slow: the frame is delayed until it is ready
+            m.handleRequest({"id": "3", "request": "update channels", "layer": "1", "channels": [
+                {"address": "513", "value": "21"},
+            ]}, 1)
+            com.fire(m)
+            self.assertEqual(com.sent, [])
+            self.assertEqual(len(com.timeouts), 1)
+            com.fds[pout] = 0
+            com.fire(m)
+            self.assertEqual(com.sent[0][1], "\0\x15" + "\0" * 511)
+
+            m.onEvent(("file descriptor unmanaged", pout))
+            self.assertEqual(m.outputs, {})
+        finally:
+            os.close(pin)
+            os.close(pout)
+
+    def test_driver_output_unscheduled(self):
+        com = FakeCom()
+        m = Merger(com)
+        pin, pout = os.pipe()
+        try:
+            m.attachDriver(1, pout)
+            com.sent = []
+
+            ## the driver is slow: without scheduler, a timeout retries
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "513", "value": "20"},
+            ]}, 1)
+            self.assertEqual(com.sent, [])
+            self.assertEqual(com.timeouts, [(1.0 / FRAME_RATE, ("output",))])
+            com.fire(m)
+            self.assertEqual(com.sent, [])
+            self.assertEqual(len(com.timeouts), 1)
+            com.fds[pout] = 0
+            com.fire(m)
+            self.assertEqual(com.sent, [(pout, "\0\x14" + "\0" * 511)])
+            self.assertEqual(com.timeouts, [])
+            self.assertEqual(m.outputPending, None)
+        finally:
+            m.onEvent(("file descriptor unmanaged", pout))
+            os.close(pin)
+            os.close(pout)
+
+    def test_driver_exit(self):
+        com = CommunicationManager()
+        m = Merger(com, rate=FRAME_RATE)
+        def turn(duration):
+            end = time.time() + duration
+            while time.time() < end:
+                com.setTimeout(0.01)
+                com.loop()
+
+        output = m.spawnDriver(0, [sys.executable, "-c", "import sys\nwhile sys.stdin.read(513): pass"])
+        try:
+            turn(0.1)
+            self.assertEqual(com.outDataLen(output.fd), 0)
+            output.process.kill()
+            output.process.wait()
+
+            ## the next frame fails with EPIPE: the output is detached
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "1", "value": "10"},
+            ]}, 1)
+            turn(0.2)
+            self.assertEqual(m.outputs, {})
+            self.assertFalse(output.fd in com.chs)
+
+            ## and no retry ticks are left
+            merges = m.scheduler.merges
+            turn(0.2)
+            self.assertEqual(m.scheduler.merges, merges)
+        finally:
+            if m.outputs:
+                output.close()
+            for fd in com.wakeupPipe:
+                os.close(fd)
+            com.poll.close()
+
+    def test_shared_galaxy(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            m = Merger()
+            m.exportGalaxy(path, 2)
+            reader = SharedGalaxyReader(path)
+            self.assertEqual(reader.universes, 2)
+            sequence, frame = reader.read(0)
+            self.assertEqual(sequence % 2, 0)
+            self.assertEqual(frame, "\0" * 513)
+
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "2", "value": "10"},
+                {"address": "1025", "value": "30"},
+                {"address": "1030", "value": "30"},
+            ]}, 1)
+            sequence2, frame = reader.read(0)
+            self.assertTrue(sequence2 > sequence)
+            self.assertEqual(frame[:3], "\0\0\x0a")
+            sequence, frames = reader.read()
+            self.assertEqual(len(frames), 2 * 513)
+            self.assertRaises(ValueError, reader.read, 2)
+            reader.close()
+        finally:
+            os.unlink(path)
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "snapshot")
+        try:
+            m = Merger()
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "status": "persistent", "channels": [
+                {"address": "1", "value": "100"},
+                {"address": "513", "value": "4660", "nbChan": "2", "mixType": "max"},
+            ]}, 1)
+            m.handleRequest({"id": "2", "request": "new layer", "layer": "2", "channels": [
+                {"address": "1", "value": "200", "mixType": 0.5},
+                {"address": "3", "value": "50"},
+            ]}, 1)
+            m.handleRequest({"id": "3", "request": "new master", "master": "front", "level": 0.5, "channels": [
+                {"address": "3"},
+            ]}, 1)
+            r = m.handleRequest({"id": "4", "request": "snapshot"}, 1)
+            self.assertTrue("error" in r)
+            m.startSnapshots(path)
+            r = m.handleRequest({"id": "5", "request": "snapshot"}, 1)
+            self.assertEqual(r, {"id": "5", "status": "ok"})
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+            restored = Merger()
+            restored.restore(path)
+            self.assertEqual([l.level for l in restored.layers], ["1"])
+            self.assertEqual(restored.getLayer("1").status, "persistent")
+            self.assertEqual(restored.getLayer("1").channels[513].mixType, "max")
+            ## the last look, volatile layer included, until the next merge
+            self.assertEqual(restored.galaxy.universes, m.galaxy.universes)
+            self.assertEqual(restored.outputGalaxy()[3], 25)
+            self.assertEqual(restored.dirty, set([1, 3]))
+            restored.mergeDirty()
+            self.assertEqual((restored.galaxy[1], restored.galaxy[3]), (100, 0))
+            self.assertEqual((restored.galaxy[513], restored.galaxy[514]), (0x12, 0x34))
+
+            data = open(path).read()
+            open(path, "w").write(data[:-1] + chr(ord(data[-1]) ^ 1))
+            self.assertRaises(ValueError, Merger().restore, path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_snapshot_errors(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "snapshot")
+        try:
+            com = FakeCom()
+            m = Merger(com)
+            m.startSnapshots(path, 10)
+            self.assertEqual(com.timeouts, [(10, ("snapshot", 10))])
+            com.fire(m)
+            self.assertTrue(os.path.exists(path))
+
+            ## unchanged: not written again
+            os.remove(path)
+            com.fire(m)
+            self.assertFalse(os.path.exists(path))
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "status": "persistent", "channels": [
+                {"address": "1", "value": "100"},
+            ]}, 1)
+            com.fire(m)
+            self.assertTrue(os.path.exists(path))
+
+            ## a failing save doesn't stop the periodic snapshots, nor quit
+            m.handleRequest({"id": "2", "request": "update channels", "layer": "1", "channels": [
+                {"address": "1", "value": "50"},
+            ]}, 1)
+            m.snapshotPath = os.path.join(directory, "missing", "snapshot")
+            com.fire(m)
+            self.assertEqual(com.timeouts, [(10, ("snapshot", 10))])
+            r = m.handleRequest({"id": "3", "request": "quit"}, 1)
+            self.assertTrue("error" in r)
+            self.assertTrue(com.stopped)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_frame_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "log")
+            writer = FrameLogWriter(path)
+            frames = bytearray(2 * 513)
+            expected = []
+            for i in range(30):
+                frames[1 + i] = i + 1
+                frames[513 + 1 + i * 16] = 255 - i
+                expected.append((100 + i * 0.25, str(frames)))
+                writer.write(*expected[-1])
+            writer.close()
+            ## killed while writing
+            open(path, "a").write("\x02\0\0")
+
+            reader = FrameLogReader(path)
+            self.assertEqual([timestamp for timestamp, offset in reader.index()], range(100, 108))
+            self.assertEqual([(timestamp, str(f)) for timestamp, f in reader.frames()], expected)
+            self.assertEqual([(timestamp, str(f)) for timestamp, f in reader.frames(103.1)], expected[12:])
+            timestamp, f = reader.frameAt(102.6)
+            self.assertEqual((timestamp, str(f)), expected[10])
+            self.assertEqual(reader.frameAt(50)[0], 100)
+            self.assertEqual(reader.frameAt(200)[0], expected[-1][0])
+            data = summary(reader)
+            self.assertEqual((data["frames"], data["keyframes"], data["universes"]), (30, 8, 2))
+            self.assertTrue(data["bytes"] < 8 * 2 * 513 + 30 * 100)
+            reader.close()
+
+            m = Merger()
+            m.startRecording(path)
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "1", "value": "10"},
+            ]}, 1)
+            m.handleRequest({"id": "2", "request": "new channels", "layer": "1", "channels": [
+                {"address": "600", "value": "20"},
+            ]}, 1)
+            m.stopRecording()
+            reader = FrameLogReader(path)
+            recorded = [str(f) for timestamp, f in reader.frames()]
+            self.assertEqual(recorded[1:], ["\0\x0a" + "\0" * 511, "".join(map(str, m.galaxy.universes))])
+            reader.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_player(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "log")
+            writer = FrameLogWriter(path)
+            frames = bytearray(513)
+            for i in range(20):
+                frames[1 + i] = 10 + i
+                if i == 15:
+                    frames += bytearray(513)
+                    frames[513 + 3] = 33
+                writer.write(100 + i * 0.25, str(frames))
+            writer.close()
+
+            com = FakeCom()
+            m = Merger()
+            reader = FrameLogReader(path)
+            player = Player(com, reader, "5", start=2.1)
+            binary = BinaryProtocol()
+
+            def forward():
+                for cid, data in com.sent:
+                    if cid == player.control:
+                        r = m.handleRequest(data, 1)
+                        self.assertFalse("error" in r, r)
+                        if r["id"] == "layer":
+                            player.onEvent(("packet", cid, r))
+                    elif data != MAGIC:
+                        updates, consumed = binary.parse(data)
+                        self.assertEqual(m.channelUpdates(updates), [])
+                del com.sent[:]
+
+            forward()
+            ## the frame at 102.0
+            self.assertEqual(m.galaxy.toList()[0][:10], range(10, 19) + [0])
+            self.assertEqual(len(com.timeouts), 1)
+
+            player.timeout = None
+            player.advance(player.wallStart + 0.6)
+            forward()
+            self.assertEqual(m.galaxy.toList()[0][:12], range(10, 21) + [0])
+
+            player.timeout = None
+            player.advance(player.wallStart + 10)
+            forward()
+            self.assertEqual(m.galaxy.toList()[0][:21], range(10, 30) + [0])
+            self.assertEqual(m.galaxy[515], 33)
+            self.assertTrue(com.stopped)
+            reader.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(AsyncioCommunicationManager is None, "asyncio is not available")
+    def test_asyncio_manager(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "merger")
+            com = AsyncioCommunicationManager()
+            m = Merger(com)
+
+            def later(self, request, cid, r):
+                ## a handler answering from the event loop
+                future = asyncio.Future(loop=com.eventLoop)
+                com.eventLoop.call_later(0.01, future.set_result, None)
+                r["status"] = "later"
+                return future
+            m.request_type = dict(Merger.request_type, later=later)
+
+            ## the client runs on the same event loop
+            clientCom = AsyncioCommunicationManager(eventLoop=com.eventLoop)
+            answers = []
+            def client(event):
+                if event[0] == "packet":
+                    answers.append(event[2])
+                    if len(answers) == 4:
+                        clientCom.stop()
+                        com.stop()
+            clientCom.registerHighLevelListener(client)
+            com.listenUnix(path, negotiate, protoOut)
+            cid = clientCom.connectUnix(path, protoIn, protoOut)
+            clientCom.send(cid, {"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "1", "value": "10"},
+            ]})
+            clientCom.send(cid, {"id": "2", "request": "later"})
+            clientCom.send(cid, {"id": "3", "request": "output"})
+            clientCom.send(cid, {"id": "4", "request": "remove layer"})
+            com.setTimeout(5, ("give up",))
+            com.main()
+
+            self.assertEqual([a["id"] for a in answers], ["1", "3", "4", "2"])
+            self.assertEqual(answers[1]["output"][0][0], 10)
+            self.assertTrue("error" in answers[2])
+            self.assertEqual(answers[3]["status"], "later")
+            self.assertEqual((com.chs, clientCom.chs), ({}, {}))
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(NumpyEngine is None, "numpy is not available")
+    def test_numpy_engine(self):
+        rand = random.Random(42)
+        for run in range(20):
+            m = Merger()
+            mnp = Merger(engine=NumpyEngine())
+            for level in range(1, 8):
+                l = Layer(str(level))
+                for address in rand.sample(range(1, 1500), 200):
+                    nbChan = rand.choice((1, 1, 1, 2))
+                    if any(a in l.channels for a in range(address - 1, address + nbChan)):
+                        continue
+                    mixType = rand.choice((rand.random(), 1.0, 0.0, "min", "max"))
+                    l.addChannel(address, rand.randrange(256 ** nbChan), mixType, nbChan)
+                m.addLayer(l)
+                mnp.addLayer(l)
+            m.merge()
+            mnp.merge()
+            self.assertEqual(m.galaxy.universes, mnp.galaxy.universes)
+
+            # cached arrays follow layer changes
+            l.updateChannel(rand.choice(l.channels.keys()), value=0, mixType=0.5)
+            m.merge()
+            mnp.merge()
+            self.assertEqual(m.galaxy.universes, mnp.galaxy.universes)
+
+    @unittest.skipIf(NumpyEngine is None, "numpy is not available")
+    def test_numpy_engine_overlap(self):
+        def build(m):
+            m.handleRequest({"id": "1", "request": "new layer", "layer": "1", "channels": [
+                {"address": "10", "value": "5000", "nbChan": 2},
+                {"address": "11", "value": "200", "mixType": 0.5},
+                {"address": "12", "value": "7"},
+            ]}, 1)
+            m.handleRequest({"id": "2", "request": "new layer", "layer": "2", "channels": [
+                {"address": "11", "value": "100", "mixType": "max"},
+                {"address": "20", "value": "1"},
+            ]}, 1)
+            return m
+
+        ## full merges
+        m = build(Merger())
+        mnp = build(Merger(engine=NumpyEngine()))
+        m.merge()
+        mnp.merge()
+        self.assertEqual(m.galaxy.universes, mnp.galaxy.universes)
+
+        ## the prefix is composited by the engine
+        for merger in (m, mnp):
+            merger.getLayer("1").changedAt = 0
+            merger.prefixCheck = 0
+            merger.handleRequest({"id": "3", "request": "update channels", "layer": "2", "channels": [
+                {"address": "20", "value": "2"},
+            ]}, 1)
+            self.assertEqual(merger.prefixKey, merger.getLayer("2").key)
+        self.assertEqual(m.galaxy.universes, mnp.galaxy.universes)
+        m.merge()
+        self.assertEqual(m.galaxy.universes, mnp.galaxy.universes)
 
 
 if __name__ == "__main__":